@@ -0,0 +1,183 @@
+"""
+Admission control.
+
+Every caller has a token bucket: RATE_LIMIT_BURST tokens, refilled at
+RATE_LIMIT_RATE tokens per second. A request takes the cost its endpoint
+declares with @cost (DEFAULT_COST otherwise) from the bucket of the user
+resolved by oath.get_current_user_id, or, on /login and /auth, from the bucket
+of the client address. A caller with too few tokens gets 429 with the seconds
+until it has enough in Retry-After.
+
+Endpoints declared expensive also share EXPENSIVE_CONCURRENCY slots per
+worker process; when they are all taken new expensive requests get 429 right
+away instead of queueing for database connections in front of everyone else.
+
+Buckets live in the process, or in redis when RATE_LIMIT_URL is set so that
+all workers and nodes share them. RATE_LIMITS=off disables both checks.
+"""
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException, Request, status
+
+import metrics
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITS = os.getenv('RATE_LIMITS', 'on')
+RATE_LIMIT_RATE = float(os.getenv('RATE_LIMIT_RATE', 10))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', 60))
+RATE_LIMIT_BUCKETS = int(os.getenv('RATE_LIMIT_BUCKETS', 100000))
+# redis://... to share the buckets between workers, in-process buckets if empty
+RATE_LIMIT_URL = os.getenv('RATE_LIMIT_URL', '')
+EXPENSIVE_CONCURRENCY = int(os.getenv('EXPENSIVE_CONCURRENCY', 8))
+DEFAULT_COST = 1
+
+
+class Admission:
+    def __init__(self, tokens: float, expensive: bool = False):
+        self.tokens = tokens
+        self.expensive = expensive
+
+
+DEFAULT_ADMISSION = Admission(DEFAULT_COST)
+
+
+def cost(tokens: float, expensive: bool = False):
+    """
+    Declares how many tokens a call of the decorated endpoint takes and whether it is expensive
+    """
+    def decorator(endpoint):
+        endpoint.admission = Admission(tokens, expensive)
+        return endpoint
+    return decorator
+
+
+def too_many_requests(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many requests, try again later",
+        headers={"Retry-After": str(max(math.ceil(retry_after), 1))},
+    )
+
+
+class MemoryBuckets:
+    """
+    Buckets of a single process, the least recently used ones are dropped above `maxsize`
+    (a dropped bucket comes back full)
+    """
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    async def take(self, key: str, tokens: float, rate: float, burst: float) -> float:
+        now = time.monotonic()
+        available, updated_at = self._buckets.get(key, (burst, now))
+        available = min(burst, available + (now - updated_at) * rate)
+        retry_after = 0.0
+        if available < tokens:
+            retry_after = (tokens - available) / rate
+        else:
+            available -= tokens
+        self._buckets[key] = (available, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+class RedisBuckets:
+    """
+    Buckets shared by every worker and node, updated atomically by a script on the redis clock
+    """
+    SCRIPT = """
+        local rate, burst, tokens = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local clock = redis.call('TIME')
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+        local state = redis.call('HMGET', KEYS[1], 'available', 'updated_at')
+        local available = tonumber(state[1]) or burst
+        local updated_at = tonumber(state[2]) or now
+        available = math.min(burst, available + (now - updated_at) * rate)
+        local retry_after = 0
+        if available < tokens then
+            retry_after = (tokens - available) / rate
+        else
+            available = available - tokens
+        end
+        redis.call('HSET', KEYS[1], 'available', available, 'updated_at', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(retry_after)
+    """
+
+    def __init__(self, url: str):
+        if redis is None:
+            raise RuntimeError('RATE_LIMIT_URL is set but the redis package is not installed')
+        self._client = redis.from_url(url)
+        self._take = self._client.register_script(self.SCRIPT)
+
+    async def take(self, key: str, tokens: float, rate: float, burst: float) -> float:
+        return float(await self._take(keys=[f'bucket:{key}'], args=[rate, burst, tokens]))
+
+
+def make_backend():
+    return RedisBuckets(RATE_LIMIT_URL) if RATE_LIMIT_URL else MemoryBuckets(RATE_LIMIT_BUCKETS)
+
+
+buckets = make_backend()
+_expensive_in_flight = 0
+
+
+def endpoint_admission(request: Request) -> Admission:
+    return getattr(request.scope.get('endpoint'), 'admission', DEFAULT_ADMISSION)
+
+
+async def admit(request: Request, key: str):
+    """
+    Takes the cost of the request's endpoint from the bucket of `key`, raises 429 if there are not enough tokens
+    """
+    if RATE_LIMITS == 'off':
+        return
+    tokens = min(endpoint_admission(request).tokens, RATE_LIMIT_BURST)
+    try:
+        retry_after = await buckets.take(key, tokens, RATE_LIMIT_RATE, RATE_LIMIT_BURST)
+    except Exception:
+        # a shared backend that is down must not take the API down with it
+        logger.exception('rate limit backend failed, request admitted')
+        return
+    if retry_after:
+        metrics.rejected_requests.inc(reason='rate', route=metrics.route_path(request.scope))
+        raise too_many_requests(retry_after)
+
+
+async def admit_client(request: Request):
+    """
+    Dependency of the unauthenticated routes, limits them per client address
+    """
+    await admit(request, f'client:{request.client.host if request.client else "unknown"}')
+
+
+async def expensive_slot(request: Request):
+    """
+    App-wide dependency: holds one of the EXPENSIVE_CONCURRENCY slots while an expensive endpoint runs
+    """
+    global _expensive_in_flight
+    if RATE_LIMITS == 'off' or not endpoint_admission(request).expensive:
+        yield
+        return
+    if _expensive_in_flight >= EXPENSIVE_CONCURRENCY:
+        metrics.rejected_requests.inc(reason='concurrency', route=metrics.route_path(request.scope))
+        raise too_many_requests(1)
+    _expensive_in_flight += 1
+    try:
+        yield
+    finally:
+        _expensive_in_flight -= 1
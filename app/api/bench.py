@@ -0,0 +1,369 @@
+"""
+Benchmark harness: a seeded database and concurrent clients driving the app.
+
+    python bench.py seed --announcements 1000000
+    python bench.py run --duration 60 --concurrency 32 --save bench_baseline.json
+    python bench.py run --duration 60 --concurrency 32 --baseline bench_baseline.json
+    python bench.py compare bench_baseline.json bench_new.json
+
+seed fills the empty database of DATABASE_URL with deterministic data (same --seed,
+same rows). It has to be MySQL: the schema relies on FULLTEXT indexes and MySQL
+upserts. run drives main.app in-process, or a running server with --url, with a
+weighted mix of scenarios and reports latency percentiles, throughput and SQL
+statements per request, the latter taken from /metrics (exact for one worker).
+Results saved with --save serve as the baseline of later runs.
+
+Admission control would throttle the harness itself (all in-process clients
+share one address), so in-process runs switch it off unless --rate-limits is
+given; start a server measured with --url with RATE_LIMITS=off.
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from PIL import Image
+from sqlalchemy import func, insert, select, update
+
+import admission
+import database
+import hashing
+import migrations
+import models
+import price_stats
+import refdata
+import storage
+
+SEED_PASSWORD = 'bench-password'
+SEED_BATCH_SIZE = 5000
+PLACEHOLDER_IMAGES = 20
+
+WORDS = [
+    'квартира', 'дом', 'машина', 'велосипед', 'диван', 'телефон', 'ноутбук', 'стол', 'шкаф', 'куртка',
+    'коляска', 'гитара', 'холодильник', 'телевизор', 'часы', 'кроссовки', 'сумка', 'кресло', 'ковер', 'лампа',
+    'продам', 'новый', 'отличный', 'срочно', 'недорого', 'торг', 'состояние', 'доставка', 'гарантия', 'оригинал',
+    'белый', 'черный', 'большой', 'маленький', 'удобный', 'качественный', 'быстро', 'центр', 'район', 'метро',
+]
+SEARCH_WORDS = WORDS[:20]
+
+# scenario -> (weight, method and route in /metrics)
+SCENARIOS = {
+    'listing': (30, 'GET', '/announcements'),
+    'filter': (20, 'GET', '/announcements'),
+    'town': (10, 'GET', '/announcements/town/{town_id}'),
+    'show': (10, 'GET', '/announcements/{announcement_id}'),
+    'search': (10, 'GET', '/announcements/search/{word}'),
+    'favorite': (10, 'POST', '/user/{current_user_id}/favorite/{announcement_id}'),
+    'create': (5, 'POST', '/create_announcement'),
+    'login': (5, 'POST', '/login'),
+}
+REPORTED = ('requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'sql_per_request')
+
+
+def email(user_id: int) -> str:
+    return f'user{user_id}@bench.test'
+
+
+def placeholder(index: int) -> bytes:
+    image = Image.new('RGB', (640, 480), ((index * 53) % 256, (index * 97) % 256, (index * 151) % 256))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def store_placeholders():
+    """
+    (data_path, content_hash) of PLACEHOLDER_IMAGES files in MEDIA_ROOT, shared by all seeded images
+    """
+    images = []
+    for index in range(PLACEHOLDER_IMAGES):
+        content = placeholder(index)
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = storage.content_path(content_hash, '.jpg')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        images.append((str(path), content_hash))
+    return images
+
+
+async def insert_rows(table, rows):
+    """
+    Inserts the rows of the iterable SEED_BATCH_SIZE at a time, one transaction per batch
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= SEED_BATCH_SIZE:
+            async with database.engine.begin() as conn:
+                await conn.execute(insert(table), batch)
+            batch = []
+    if batch:
+        async with database.engine.begin() as conn:
+            await conn.execute(insert(table), batch)
+
+
+async def seed(args):
+    await migrations.upgrade()
+    async with database.SessionLocal() as db:
+        if await db.scalar(select(func.count()).select_from(models.Users)):
+            raise SystemExit('the database is not empty, seed needs an empty one')
+
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    password_hash = hashing.Hash.bcrypt(SEED_PASSWORD)
+    images = store_placeholders()
+
+    await insert_rows(models.Towns.__table__,
+                      ({'id': i, 'town_name': f'Город {i}'} for i in range(1, args.towns + 1)))
+    await insert_rows(models.Categories.__table__,
+                      ({'id': i, 'category_name': f'Категория {i}'} for i in range(1, args.categories + 1)))
+    await insert_rows(models.Users.__table__, ({
+        'id': i,
+        'first_name': f'Имя{i}',
+        'last_name': f'Фамилия{i}',
+        'email': email(i),
+        'mobile_phone': 79000000000 + i,
+        'town_id': rng.randint(1, args.towns),
+        'password_hash': password_hash,
+    } for i in range(1, args.users + 1)))
+    await insert_rows(models.Announcements.__table__, ({
+        'id': i,
+        'user_id': rng.randint(1, args.users),
+        'price': round(math.exp(rng.uniform(math.log(100), math.log(10000000))), 2),
+        'category_id': rng.randint(1, args.categories),
+        'text': ' '.join(rng.choices(WORDS, k=rng.randint(5, 30))),
+        'town_id': rng.randint(1, args.towns),
+        'created_at': now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600)),
+    } for i in range(1, args.announcements + 1)))
+    await insert_rows(models.Images.__table__, (
+        {'announcement_id': i, 'data_path': data_path, 'content_hash': content_hash}
+        for i in range(1, args.announcements + 1)
+        for data_path, content_hash in rng.sample(images, rng.randint(0, 3))
+    ))
+    await insert_rows(models.Favorites.__table__, (
+        {'user_id': user_id, 'announcement_id': announcement_id}
+        for user_id in range(1, args.users + 1)
+        for announcement_id in set(rng.randint(1, args.announcements) for _ in range(rng.randint(0, 20)))
+    ))
+
+    async with database.SessionLocal() as db:
+        count = (select(func.count())
+                 .where(models.Favorites.announcement_id == models.Announcements.id)
+                 .scalar_subquery())
+        await db.execute(update(models.Announcements).values(favorites_count=count))
+        await refdata.bump_version(db)
+        await db.commit()
+    await price_stats.rebuild()
+    print(f'seeded {args.towns} towns, {args.categories} categories, {args.users} users, '
+          f'{args.announcements} announcements')
+
+
+async def dataset():
+    async with database.SessionLocal() as db:
+        return {
+            'users': await db.scalar(select(func.max(models.Users.id))),
+            'towns': await db.scalar(select(func.max(models.Towns.id))),
+            'categories': await db.scalar(select(func.max(models.Categories.id))),
+            'announcements': await db.scalar(select(func.max(models.Announcements.id))),
+        }
+
+
+async def login(client: httpx.AsyncClient, user_id: int):
+    return await client.post('/login', data={'username': email(user_id), 'password': SEED_PASSWORD})
+
+
+async def scenario(name: str, client: httpx.AsyncClient, data: dict, rng: random.Random):
+    if name == 'listing':
+        return await client.get('/announcements', params={'limit': 20})
+    if name == 'filter':
+        return await client.get('/announcements', params={
+            'town_id': rng.randint(1, data['towns']),
+            'category_id': rng.randint(1, data['categories']),
+            'sort': rng.choice(['newest', 'price_asc']),
+        })
+    if name == 'town':
+        return await client.get(f'/announcements/town/{rng.randint(1, data["towns"])}')
+    if name == 'show':
+        return await client.get(f'/announcements/{rng.randint(1, data["announcements"])}')
+    if name == 'search':
+        return await client.get(f'/announcements/search/{rng.choice(SEARCH_WORDS)}')
+    if name == 'favorite':
+        return await client.post(f'/user/0/favorite/{rng.randint(1, data["announcements"])}')
+    if name == 'create':
+        return await client.post('/create_announcement', data={
+            'price': rng.randint(100, 100000),
+            'category_id': rng.randint(1, data['categories']),
+            'text': ' '.join(rng.choices(WORDS, k=10)),
+            'town_id': rng.randint(1, data['towns']),
+        }, files={'files': ('photo.jpg', data['image'], 'image/jpeg')})
+    if name == 'login':
+        return await login(client, rng.randint(1, data['users']))
+    raise ValueError(name)
+
+
+async def worker(number: int, make_client, data: dict, names, weights, deadline: float, samples):
+    rng = random.Random(number)
+    async with make_client() as client:
+        response = await login(client, rng.randint(1, data['users']))
+        response.raise_for_status()
+        client.headers['Authorization'] = f'Bearer {response.json()["access_token"]}'
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                status = (await scenario(name, client, data, rng)).status_code
+            except httpx.HTTPError:
+                status = 0
+            samples.append((name, time.perf_counter() - started, status))
+
+
+METRIC_LINE = re.compile(r'^http_request_sql_statements_(sum|count)\{(.*)\} (\S+)$')
+
+
+async def sql_statements(client: httpx.AsyncClient):
+    """
+    (method, route) -> [statements, requests] from /metrics
+    """
+    totals = {}
+    for line in (await client.get('/metrics')).text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            labels = dict(re.findall(r'(\w+)="([^"]*)"', match[2]))
+            totals.setdefault((labels['method'], labels['route']), [0.0, 0.0])[match[1] == 'count'] = \
+                float(match[3])
+    return totals
+
+
+def percentile(values, q: float) -> float:
+    return values[max(math.ceil(q * len(values)) - 1, 0)] * 1000 if values else 0.0
+
+
+def summarize(samples, duration: float, before: dict, after: dict) -> dict:
+    results = {}
+    for name, (_, method, route) in SCENARIOS.items():
+        latencies = sorted(latency for sample, latency, _ in samples if sample == name)
+        if not latencies:
+            continue
+        statements, requests = [a - b for a, b in zip(after.get((method, route), [0, 0]),
+                                                      before.get((method, route), [0, 0]))]
+        results[name] = {
+            'requests': len(latencies),
+            'errors': sum(1 for sample, _, status in samples if sample == name and not 200 <= status < 400),
+            'rps': round(len(latencies) / duration, 2),
+            'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            # listing and filter share a route, so they share the figure too
+            'sql_per_request': round(statements / requests, 2) if requests else None,
+        }
+    return results
+
+
+def print_results(results: dict, baseline: dict = None):
+    print(f'{"scenario":<10}' + ''.join(f'{column:>22}' for column in REPORTED))
+    for name, result in results.items():
+        cells = []
+        for column in REPORTED:
+            value = result[column]
+            old = (baseline or {}).get(name, {}).get(column)
+            if old and value is not None:
+                cells.append(f'{value} ({(value - old) / old:+.0%})')
+            else:
+                cells.append(f'{value}')
+        print(f'{name:<10}' + ''.join(f'{cell:>22}' for cell in cells))
+
+
+async def run(args):
+    names = args.scenarios.split(',') if args.scenarios else list(SCENARIOS)
+    weights = [SCENARIOS[name][0] for name in names]
+    database.connect()
+    data = {**await dataset(), 'image': placeholder(0)}
+    app = None
+    if args.url:
+        def make_client():
+            return httpx.AsyncClient(base_url=args.url, timeout=60)
+    else:
+        import main
+        app = main.app
+        if not args.rate_limits:
+            admission.RATE_LIMITS = 'off'
+        await app.router.startup()
+
+        def make_client():
+            return httpx.AsyncClient(app=app, base_url='http://bench', timeout=60)
+    client = make_client()
+    try:
+        before = await sql_statements(client)
+        samples = []
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(number, make_client, data, names, weights, started + args.duration, samples)
+                               for number in range(args.concurrency)))
+        duration = time.perf_counter() - started
+        results = summarize(samples, duration, before, await sql_statements(client))
+    finally:
+        await client.aclose()
+        if app is not None:
+            await app.router.shutdown()
+        await database.disconnect()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump({
+                'created_at': datetime.utcnow().isoformat(),
+                'target': args.url or 'in-process',
+                'duration': args.duration,
+                'concurrency': args.concurrency,
+                'dataset': {key: value for key, value in data.items() if key != 'image'},
+                'results': results,
+            }, file, indent=2)
+
+
+def compare(args):
+    with open(args.baseline) as file:
+        baseline = json.load(file)['results']
+    with open(args.results) as file:
+        results = json.load(file)['results']
+    print_results(results, baseline)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the announcements API')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='fill an empty database')
+    seed_parser.add_argument('--seed', type=int, default=1)
+    seed_parser.add_argument('--towns', type=int, default=50)
+    seed_parser.add_argument('--categories', type=int, default=30)
+    seed_parser.add_argument('--users', type=int, default=10000)
+    seed_parser.add_argument('--announcements', type=int, default=100000)
+
+    run_parser = commands.add_parser('run', help='drive the app with concurrent clients')
+    run_parser.add_argument('--url', help='base url of a running server, main.app in-process if not set')
+    run_parser.add_argument('--duration', type=float, default=30)
+    run_parser.add_argument('--concurrency', type=int, default=16)
+    run_parser.add_argument('--rate-limits', action='store_true', help='keep admission control on in-process')
+    run_parser.add_argument('--scenarios', help=f'comma separated subset of {",".join(SCENARIOS)}')
+    run_parser.add_argument('--baseline', help='results file to compare with')
+    run_parser.add_argument('--save', help='file to store the results in')
+
+    compare_parser = commands.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        compare(args)
+    else:
+        asyncio.run(seed(args) if args.command == 'seed' else run(args))
@@ -0,0 +1,88 @@
+"""
+Query budgets of the routes.
+
+Every endpoint declares with @query_budget how many SQL statements it may run and
+how many rows they may return per request, in the worst case of cold caches.
+MetricsMiddleware counts both for every request and passes them to check():
+
+    QUERY_BUDGETS=off      nothing is checked (default)
+    QUERY_BUDGETS=log      requests over budget are logged with their statements
+    QUERY_BUDGETS=enforce  they raise QueryBudgetExceeded, so test clients fail;
+                           endpoints without a declared budget do too
+
+Lookups that serve every route from a cache (token versions, reference data,
+replica health) run inside `unbudgeted()` and are not charged to the route.
+"""
+import contextvars
+import logging
+import os
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+QUERY_BUDGETS = os.getenv('QUERY_BUDGETS', 'off')
+
+_unbudgeted = contextvars.ContextVar('unbudgeted', default=False)
+
+
+class QueryBudget:
+    def __init__(self, statements: Optional[int], rows: Optional[int] = None):
+        self.statements = statements
+        self.rows = rows
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(statements: Optional[int], rows: Optional[int] = None):
+    """
+    Declares the budget of the decorated endpoint, None for no limit
+    """
+    def decorator(endpoint):
+        endpoint.query_budget = QueryBudget(statements, rows)
+        return endpoint
+    return decorator
+
+
+@contextmanager
+def unbudgeted():
+    token = _unbudgeted.set(True)
+    try:
+        yield
+    finally:
+        _unbudgeted.reset(token)
+
+
+def is_unbudgeted() -> bool:
+    return _unbudgeted.get()
+
+
+def violations(endpoint, statements: int, rows: int):
+    budget = getattr(endpoint, 'query_budget', None)
+    if budget is None:
+        # the framework's own routes (docs, openapi.json) have no budget and run no SQL
+        if endpoint is not None and not endpoint.__module__.startswith(('fastapi.', 'starlette.')):
+            yield 'no query budget declared'
+        return
+    if budget.statements is not None and statements > budget.statements:
+        yield f'{statements} SQL statements, budget {budget.statements}'
+    if budget.rows is not None and rows > budget.rows:
+        yield f'{rows} rows fetched, budget {budget.rows}'
+
+
+def check(method: str, path: str, endpoint, statements: int, rows: int, captured):
+    """
+    Reports a request that exceeded the budget of its endpoint, captured: (milliseconds, statement) pairs
+    """
+    if QUERY_BUDGETS not in ('log', 'enforce'):
+        return
+    problems = list(violations(endpoint, statements, rows))
+    if not problems:
+        return
+    message = f'{method} {path}: {"; ".join(problems)}\n' + \
+              '\n'.join(f'  {ms} ms: {statement}' for ms, statement in captured)
+    if QUERY_BUDGETS == 'enforce':
+        raise QueryBudgetExceeded(message)
+    logger.warning('query budget exceeded by %s', message)
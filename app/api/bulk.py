@@ -0,0 +1,254 @@
+"""
+Bulk import and export of announcements.
+
+Imports read a stream of NDJSON lines or CSV records (header row first), validate
+every record against Announcement_import_schema and insert IMPORT_BATCH_SIZE rows
+per executemany INSERT and per transaction: the stream is never held in memory and
+a failing batch never rolls back the ones before it. Rows that don't pass end up
+in the error report with their number in the stream.
+
+executemany doesn't return the ids of the new rows, so every batch stamps its
+rows with a random import_batch and reads them back by it to record their
+announcement.created events in the same transaction.
+
+Exports read the table through a server-side cursor and yield it in
+EXPORT_BATCH_SIZE chunks, in the format the import accepts.
+
+    python bulk.py import announcements.ndjson
+    python bulk.py export announcements.csv --after-id 100000
+"""
+import argparse
+import asyncio
+import codecs
+import csv
+import io
+import json
+import os
+import uuid
+from typing import AsyncIterator, List, Tuple
+
+from aiofiles import open
+from pydantic import ValidationError
+from sqlalchemy import insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import cache
+import database
+import models
+import outbox
+import price_stats
+import refdata
+import schemas
+import serializers
+import storage
+
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+# row errors listed in the report, the rest are only counted
+MAX_REPORTED_ERRORS = int(os.getenv('IMPORT_MAX_REPORTED_ERRORS', 1000))
+
+EXPORT_COLUMNS = (
+    models.Announcements.id,
+    models.Announcements.user_id,
+    models.Announcements.price,
+    models.Announcements.category_id,
+    models.Announcements.text,
+    models.Announcements.town_id,
+    models.Announcements.created_at,
+)
+
+
+async def lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        complete = pending.split('\n')
+        pending = complete.pop()
+        for line in complete:
+            yield line
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+async def records(chunks: AsyncIterator[bytes], format: schemas.Bulk_format) -> AsyncIterator[Tuple[int, dict]]:
+    """
+    (row number, fields) of every record of the stream, fields is None when the record can't be parsed
+    """
+    row = 0
+    if format == schemas.Bulk_format.ndjson:
+        async for line in lines(chunks):
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                fields = json.loads(line)
+            except ValueError:
+                fields = None
+            yield row, fields if isinstance(fields, dict) else None
+        return
+
+    header = None
+    record = []
+    async for line in lines(chunks):
+        record.append(line)
+        text = '\n'.join(record)
+        if text.count('"') % 2:
+            # a quoted field goes on on the next line
+            continue
+        record = []
+        if not text.strip():
+            continue
+        try:
+            values = next(csv.reader([text]))
+        except csv.Error:
+            # e.g. a stray quote that made the record swallow the next line
+            values = None
+        if header is None:
+            # without a header no record can be read, every one is reported malformed
+            header = values or []
+            continue
+        row += 1
+        yield row, dict(zip(header, values)) if values is not None and len(values) == len(header) else None
+    if record:
+        yield row + 1, None
+
+
+class Report:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+
+    def fail(self, row: int, errors: List[str]):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row, 'errors': errors})
+
+    def dict(self):
+        return {'imported': self.imported, 'failed': self.failed, 'errors': self.errors}
+
+
+async def insert_batch(db: AsyncSession, batch: List[Tuple[int, schemas.Announcement_import_schema]],
+                       report: Report):
+    ref = await refdata.covering([announcement.town_id for _, announcement in batch],
+                                 [announcement.category_id for _, announcement in batch])
+    users = await db.execute(select(models.Users.id)
+                             .where(models.Users.id.in_({announcement.user_id for _, announcement in batch})))
+    users = set(users.scalars().all())
+    rows = []
+    values = []
+    for row, announcement in batch:
+        errors = []
+        if announcement.user_id not in users:
+            errors.append(f'user_id: user with id {announcement.user_id} not found')
+        if announcement.town_id not in ref.towns:
+            errors.append(f'town_id: town with id {announcement.town_id} not found')
+        if announcement.category_id not in ref.categories:
+            errors.append(f'category_id: category with id {announcement.category_id} not found')
+        if errors:
+            report.fail(row, errors)
+        else:
+            rows.append(row)
+            values.append(announcement.dict())
+    if not values:
+        return
+    marker = uuid.uuid4().hex
+    try:
+        await db.execute(insert(models.Announcements), [{**announcement, 'import_batch': marker}
+                                                         for announcement in values])
+        await price_stats.apply(db, [(announcement['town_id'], announcement['category_id'], announcement['price'], 1)
+                                     for announcement in values])
+        inserted = await db.execute(select(*EXPORT_COLUMNS).where(models.Announcements.import_batch == marker))
+        await outbox.record(db, outbox.CREATED, [row._asdict() for row in inserted])
+        await db.commit()
+    except SQLAlchemyError as error:
+        await db.rollback()
+        for row in rows:
+            report.fail(row, [f'batch rejected by the database: {error.__class__.__name__}'])
+        return
+    report.imported += len(values)
+    outbox.notify()
+
+
+async def import_announcements(db: AsyncSession, chunks: AsyncIterator[bytes],
+                               format: schemas.Bulk_format = schemas.Bulk_format.ndjson) -> dict:
+    """
+    Inserts the announcements of the stream, returns Import_report fields
+    """
+    report = Report()
+    batch = []
+    async for row, fields in records(chunks, format):
+        if fields is None:
+            report.fail(row, ['malformed record'])
+            continue
+        try:
+            batch.append((row, schemas.Announcement_import_schema.parse_obj(fields)))
+        except ValidationError as error:
+            report.fail(row, [f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors()])
+            continue
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await insert_batch(db, batch, report)
+            batch = []
+    if batch:
+        await insert_batch(db, batch, report)
+    if report.imported:
+        await cache.response_cache.invalidate('announcements')
+    return report.dict()
+
+
+def encode(rows, format: schemas.Bulk_format) -> bytes:
+    if format == schemas.Bulk_format.ndjson:
+        return b''.join(serializers.dumps({**row._asdict(), 'created_at': row.created_at.isoformat()}) + b'\n'
+                        for row in rows)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+async def export_announcements(db: AsyncSession, format: schemas.Bulk_format = schemas.Bulk_format.ndjson,
+                               after_id: int = 0) -> AsyncIterator[bytes]:
+    """
+    Announcements with id above after_id in id order, streamed from a server-side cursor
+    """
+    if format == schemas.Bulk_format.csv:
+        yield encode([[column.key for column in EXPORT_COLUMNS]], format)
+    result = await db.stream(select(*EXPORT_COLUMNS)
+                             .where(models.Announcements.id > after_id)
+                             .order_by(models.Announcements.id))
+    async for rows in result.partitions(EXPORT_BATCH_SIZE):
+        yield encode(rows, format)
+
+
+async def read_file(path: str) -> AsyncIterator[bytes]:
+    async with open(path, 'rb') as file:
+        while chunk := await file.read(storage.CHUNK_SIZE):
+            yield chunk
+
+
+async def main(args):
+    format = args.format or (schemas.Bulk_format.csv if args.path.endswith('.csv') else schemas.Bulk_format.ndjson)
+    database.connect()
+    try:
+        async with database.SessionLocal() as db:
+            if args.command == 'import':
+                report = await import_announcements(db, read_file(args.path), format)
+                print(json.dumps(report, ensure_ascii=False, indent=2))
+            else:
+                async with open(args.path, 'wb') as file:
+                    async for chunk in export_announcements(db, format, args.after_id):
+                        await file.write(chunk)
+    finally:
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import / export of announcements')
+    parser.add_argument('command', choices=['import', 'export'])
+    parser.add_argument('path')
+    parser.add_argument('--format', type=schemas.Bulk_format, choices=list(schemas.Bulk_format),
+                        help='defaults to csv for *.csv files, ndjson otherwise')
+    parser.add_argument('--after-id', type=int, default=0, help='export announcements with a greater id only')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,220 @@
+import hashlib
+import os
+import pickle
+import time
+from collections import OrderedDict
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import parse_obj_as
+
+import database
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+# seconds a cached response lives at most, invalidation normally drops it earlier
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 60))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 10000))
+# redis://... to share the response cache between workers, in-process cache if empty
+CACHE_URL = os.getenv('CACHE_URL', '')
+
+
+class TTLCache:
+    """
+    In-process key-value cache: entries expire after `ttl` seconds,
+    the least recently used ones are evicted above `maxsize`.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+class MemoryBackend:
+    """
+    Cache backend of a single process, LRU + TTL
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self._entries = TTLCache(ttl=RESPONSE_CACHE_TTL, maxsize=maxsize)
+        # never evicted, a counter falling back to an old value would revive stale entries
+        self._counters = {}
+
+    async def get(self, key):
+        return self._entries.get(key)
+
+    async def get_many(self, keys) -> list:
+        return [self._entries.get(key) for key in keys]
+
+    async def set(self, key, value, ttl: float):
+        self._entries.set(key, value, ttl)
+
+    async def set_many(self, items: dict, ttl: float):
+        for key, value in items.items():
+            self._entries.set(key, value, ttl)
+
+    async def delete(self, key):
+        self._entries.delete(key)
+
+    async def counter(self, key) -> int:
+        return self._counters.get(key, 0)
+
+    async def incr(self, key) -> int:
+        self._counters[key] = self._counters.get(key, 0) + 1
+        return self._counters[key]
+
+
+class RedisBackend:
+    """
+    Cache backend shared by every worker and node
+    """
+
+    def __init__(self, url: str):
+        if redis is None:
+            raise RuntimeError('CACHE_URL is set but the redis package is not installed')
+        self._client = redis.from_url(url)
+
+    async def get(self, key):
+        value = await self._client.get(key)
+        return None if value is None else pickle.loads(value)
+
+    async def get_many(self, keys) -> list:
+        keys = list(keys)
+        values = await self._client.mget(keys) if keys else []
+        return [None if value is None else pickle.loads(value) for value in values]
+
+    async def set(self, key, value, ttl: float):
+        await self._client.set(key, pickle.dumps(value), ex=int(ttl))
+
+    async def set_many(self, items: dict, ttl: float):
+        async with self._client.pipeline(transaction=False) as pipeline:
+            for key, value in items.items():
+                pipeline.set(key, pickle.dumps(value), ex=int(ttl))
+            await pipeline.execute()
+
+    async def delete(self, key):
+        await self._client.delete(key)
+
+    async def counter(self, key) -> int:
+        return int(await self._client.get(key) or 0)
+
+    async def incr(self, key) -> int:
+        return await self._client.incr(key)
+
+
+def make_backend():
+    return RedisBackend(CACHE_URL) if CACHE_URL else MemoryBackend(RESPONSE_CACHE_SIZE)
+
+
+def etag(body: bytes) -> str:
+    return f'"{hashlib.sha1(body).hexdigest()}"'
+
+
+class ResponseCache:
+    """
+    Cache of JSON responses, keyed by namespace + path + query string.
+
+    Every namespace has a generation counter that is part of the key: invalidate() bumps it,
+    so all responses of the namespace are dropped at once without scanning the backend.
+    Responses carry an ETag, a matching If-None-Match is answered with 304 straight from the cache.
+
+    Two cases skip the cache so that a write is never hidden behind it: clients inside their
+    read-your-writes window (database.is_recent_writer) get a fresh response and store nothing,
+    and responses read from a replica are not stored for DB_REPLICA_MAX_LAG seconds after an
+    invalidation of their namespace, the replica may not have the write yet.
+    """
+    # response headers set by the handlers that are cached along with the body
+    CACHED_HEADERS = ('x-next-cursor',)
+    # part of every key, changed with the layout of the entries so a shared backend never serves old ones
+    ENTRY_VERSION = 3
+
+    def __init__(self, backend, ttl: float = RESPONSE_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+
+    async def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            await self.backend.incr(f'generation:{namespace}')
+            if database.replicas:
+                await self.backend.set(f'invalidated:{namespace}', True, database.REPLICA_MAX_LAG)
+
+    async def key(self, namespace: str, request: Request):
+        generation = await self.backend.counter(f'generation:{namespace}')
+        query = '&'.join(sorted(f'{k}={v}' for k, v in request.query_params.multi_items()))
+        return f'response:v{self.ENTRY_VERSION}:{namespace}:{generation}:{request.url.path}?{query}'
+
+    async def maybe_stale(self, request: Request, namespace: str) -> bool:
+        """
+        Whether the response was read from a replica that may lag behind the last invalidation of the namespace
+        """
+        if not getattr(request.state, 'read_from_replica', False):
+            return False
+        return await self.backend.get(f'invalidated:{namespace}') is not None
+
+    async def respond(self, request: Request, response: Response, namespace: str, response_model, produce,
+                      refresh=None):
+        """
+        Cached response of the request; on a miss `produce()` is awaited, validated against
+        response_model the way FastAPI does it and stored. produce() may also return the encoded JSON body.
+        With `refresh`, produce() returns (content, keys) with JSON-native content, which is stored as is,
+        and the body of every response, cached or not, is `await refresh(content, keys)`: fields that change
+        too often to invalidate the cache for are merged in after the lookup, before encoding.
+        """
+        bypass = await database.is_recent_writer(request)
+        key = await self.key(namespace, request)
+        entry = None if bypass else await self.backend.get(key)
+        if entry is None:
+            content, keys = await produce(), None
+            headers = {name: value for name, value in response.headers.items() if name in self.CACHED_HEADERS}
+            if refresh is not None:
+                content, keys = content
+            elif isinstance(content, bytes):
+                headers['ETag'] = etag(content)
+            else:
+                content = JSONResponse(jsonable_encoder(parse_obj_as(response_model, content))).body
+                headers['ETag'] = etag(content)
+            entry = (content, headers, keys)
+            if not bypass and not await self.maybe_stale(request, namespace):
+                await self.backend.set(key, entry, self.ttl)
+        body, headers, keys = entry
+        if refresh is not None:
+            # the entry holds the content here
+            body = await refresh(body, keys)
+            headers = {**headers, 'ETag': etag(body)}
+        headers = {**headers, 'Cache-Control': 'no-cache'}
+        if headers['ETag'] in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type='application/json', headers=headers)
+
+
+response_cache = ResponseCache(make_backend())
+# clients that committed in the last database.READ_YOUR_WRITES_SECONDS, see database.ClientSession
+writers = make_backend()
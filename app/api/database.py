@@ -1,17 +1,268 @@
-from sqlalchemy import create_engine
+import asyncio
+import hashlib
+import itertools
+import os
+import time
+
+from fastapi import Request
+from sqlalchemy import event, exc, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+import budgets
+import cache
+
+SQLALCHEMY_DATABASE_URL = os.getenv('DATABASE_URL', "mysql+aiomysql://root@localhost:3306/Avito_mvp")
+# comma separated, empty - no replicas
+SQLALCHEMY_REPLICA_URLS = [url for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url]
+
+ENGINE_OPTIONS = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+    # seconds to wait for a free connection before TimeoutError
+    'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 30)),
+    # below MySQL wait_timeout, so idle connections are replaced before the server drops them
+    'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+    'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+    'connect_args': {'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 10))},
+}
+
+# replicas further behind the primary than this are skipped
+REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', 5))
+# reads of a client go to the primary for this long after its last commit, in every worker: the marks are kept
+# in cache.writers, shared when CACHE_URL is set
+READ_YOUR_WRITES_SECONDS = float(os.getenv('DB_READ_YOUR_WRITES_SECONDS', 10))
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.invalidations = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Queue pool that measures how long checkouts wait for a free connection
+    """
+    metrics: PoolMetrics
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.metrics.wait_seconds_total += waited
+            self.metrics.wait_seconds_max = max(self.metrics.wait_seconds_max, waited)
+
+
+engines = {}
+
+
+def make_engine(url: str, name: str):
+    engine = create_async_engine(url, poolclass=InstrumentedQueuePool, **ENGINE_OPTIONS)
+    pool = engine.sync_engine.pool
+    pool.metrics = metrics = PoolMetrics()
+
+    @event.listens_for(pool, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        metrics.connects += 1
+
+    @event.listens_for(pool, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.checkouts += 1
+
+    @event.listens_for(pool, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        metrics.invalidations += 1
+
+    engines[name] = engine
+    return engine
+
+
+def pool_status():
+    status = {}
+    for name, engine in engines.items():
+        pool = engine.sync_engine.pool
+        status[name] = {
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            **vars(pool.metrics),
+        }
+    return status
+
+
+def writer_key(client: str) -> str:
+    return f'writer:{hashlib.sha1(client.encode()).hexdigest()}'
+
+
+class ClientSession(AsyncSession):
+    """
+    Session of a request: a commit marks its client (info['client_key']) as a recent writer
+    for READ_YOUR_WRITES_SECONDS, before the handler answers
+    """
+
+    async def commit(self):
+        await super().commit()
+        client = self.sync_session.info.get('client_key')
+        if client is not None:
+            await cache.writers.set(writer_key(client), True, READ_YOUR_WRITES_SECONDS)
 
-SQLALCHEMY_DATABASE_URL = "mysql+mysqlconnector://root@localhost:3306/Avito_mvp"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def make_sessionmaker(bind):
+    # expire_on_commit=False: attributes stay loaded after commit, AsyncSession can't lazy-load them back
+    return sessionmaker(bind=bind, class_=ClientSession, autocommit=False, autoflush=False, expire_on_commit=False)
+
+
+class Replica:
+    """
+    Read replica engine with its health: reachable and not lagging more than REPLICA_MAX_LAG seconds.
+    The health is checked in the background, at most one check at a time, and requests read the
+    result of the last one: a slow or hung replica never holds a request up.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.SessionLocal = make_sessionmaker(engine)
+        # unknown until the first check, reads go to the primary meanwhile
+        self.healthy = False
+        self.checked_at = 0.0
+        self._check_task = None
+
+        @event.listens_for(engine.sync_engine, 'handle_error')
+        def on_error(context):
+            if context.is_disconnect:
+                self.healthy = False
+
+    async def _replication_status(self):
+        async with self.engine.connect() as conn:
+            return (await conn.execute(text('SHOW SLAVE STATUS'))).mappings().first()
+
+    async def check(self):
+        self.checked_at = time.monotonic()
+        try:
+            with budgets.unbudgeted():
+                replication = await asyncio.wait_for(self._replication_status(), REPLICA_CHECK_INTERVAL)
+        except (exc.SQLAlchemyError, OSError, asyncio.TimeoutError):
+            self.healthy = False
+            return
+        if replication is None:
+            # not replicating, a copy kept in sync by other means
+            self.healthy = True
+        else:
+            lag = replication['Seconds_Behind_Master']
+            self.healthy = lag is not None and lag <= REPLICA_MAX_LAG
+
+    async def _check_in_background(self):
+        try:
+            await self.check()
+        finally:
+            self._check_task = None
+
+    def is_available(self) -> bool:
+        """
+        Health as of the last check, starts the next check when it is due and none is running
+        """
+        if self._check_task is None and time.monotonic() - self.checked_at > REPLICA_CHECK_INTERVAL:
+            self._check_task = asyncio.create_task(self._check_in_background())
+        return self.healthy
+
+    async def stop_checking(self):
+        if self._check_task is not None:
+            self._check_task.cancel()
+            await asyncio.gather(self._check_task, return_exceptions=True)
+
+
+# created by connect() in the process that uses them: pooled connections must not cross a fork
+engine = None
+replicas = []
+SessionLocal = make_sessionmaker(None)
 Base = declarative_base()
 
+_next_replica = itertools.cycle(replicas)
+
+
+def connect():
+    """
+    Creates the engines of this process and binds SessionLocal to the primary, does nothing if already connected
+    """
+    global engine, replicas, _next_replica
+    if engine is None:
+        engine = make_engine(SQLALCHEMY_DATABASE_URL, 'primary')
+        replicas = [Replica(make_engine(url, f'replica-{i}')) for i, url in enumerate(SQLALCHEMY_REPLICA_URLS)]
+        _next_replica = itertools.cycle(replicas)
+        SessionLocal.configure(bind=engine)
+    return engine
+
+
+async def disconnect():
+    """
+    Closes the pooled connections of every engine
+    """
+    global engine, replicas, _next_replica
+    for replica in replicas:
+        await replica.stop_checking()
+    for pooled in list(engines.values()):
+        await pooled.dispose()
+    engines.clear()
+    engine = None
+    replicas = []
+    _next_replica = itertools.cycle(replicas)
+    SessionLocal.configure(bind=None)
+
+
+def client_key(request: Request):
+    return request.headers.get('Authorization') or (request.client.host if request.client else None)
+
+
+async def get_db(request: Request):
+    async with SessionLocal() as db:
+        db.sync_session.info['client_key'] = client_key(request)
+        yield db
+
+
+async def is_recent_writer(request: Request) -> bool:
+    """
+    Whether the client committed something in the last READ_YOUR_WRITES_SECONDS, in any worker
+    """
+    recent = getattr(request.state, 'recent_writer', None)
+    if recent is None:
+        client = client_key(request)
+        recent = client is not None and await cache.writers.get(writer_key(client)) is not None
+        # asked by both get_read_db and the response cache
+        request.state.recent_writer = recent
+    return recent
+
+
+async def choose_replica(request: Request):
+    if await is_recent_writer(request):
+        return None
+    for _ in range(len(replicas)):
+        replica = next(_next_replica)
+        if replica.is_available():
+            return replica
+    return None
+
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_read_db(request: Request):
+    """
+    Session on the next healthy replica (round robin). Falls back to the primary when there are no healthy
+    replicas or the client committed something in the last READ_YOUR_WRITES_SECONDS.
+    """
+    replica = await choose_replica(request)
+    # responses read from a replica may be stale, see cache.ResponseCache
+    request.state.read_from_replica = replica is not None
+    async with (replica.SessionLocal if replica else SessionLocal)() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
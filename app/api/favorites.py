@@ -0,0 +1,96 @@
+"""
+Favorites of a user and the favorites_count of announcements.
+
+Every change is one statement for any number of announcements, followed by
+refresh_counts in the same transaction. The counter is recomputed from the
+favorites rows rather than incremented, so it can't drift on concurrent or
+repeated requests.
+
+A favorite toggle doesn't flush the cached announcement responses either:
+publish_counts() keeps the new counters in the cache backend under their own
+keys, and merge_counts() puts them into the cached content before it is
+encoded. Neither cache hits nor 304s ask MySQL for them.
+"""
+from typing import Iterable, List
+
+from sqlalchemy import delete, func, literal, select, update
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import cache
+import database
+import models
+
+# a published counter outlives every response cached before it, including ones read from a lagging replica
+COUNT_TTL = cache.RESPONSE_CACHE_TTL + database.REPLICA_MAX_LAG
+
+
+async def refresh_counts(db: AsyncSession, announcement_ids: Iterable[int]):
+    announcement_ids = set(announcement_ids)
+    if not announcement_ids:
+        return
+    count = (select(func.count())
+             .where(models.Favorites.announcement_id == models.Announcements.id)
+             .scalar_subquery())
+    await db.execute(update(models.Announcements)
+                     .where(models.Announcements.id.in_(announcement_ids))
+                     .values(favorites_count=count)
+                     .execution_options(synchronize_session=False))
+
+
+async def add(db: AsyncSession, user_id: int, announcement_ids: Iterable[int]) -> int:
+    """
+    Adds the existing announcements among announcement_ids, returns how many were not favorites yet
+    """
+    announcement_ids = set(announcement_ids)
+    result = await db.execute(
+        insert(models.Favorites).prefix_with('IGNORE').from_select(
+            ['user_id', 'announcement_id'],
+            select(literal(user_id), models.Announcements.id).where(models.Announcements.id.in_(announcement_ids)),
+        )
+    )
+    await refresh_counts(db, announcement_ids)
+    return result.rowcount
+
+
+async def remove(db: AsyncSession, user_id: int, announcement_ids: Iterable[int]) -> int:
+    announcement_ids = set(announcement_ids)
+    result = await db.execute(delete(models.Favorites)
+                              .where(models.Favorites.user_id == user_id,
+                                     models.Favorites.announcement_id.in_(announcement_ids)))
+    await refresh_counts(db, announcement_ids)
+    return result.rowcount
+
+
+async def announcement_ids(db: AsyncSession, user_id: int) -> List[int]:
+    result = await db.execute(select(models.Favorites.announcement_id)
+                              .where(models.Favorites.user_id == user_id)
+                              .order_by(models.Favorites.id))
+    return result.scalars().all()
+
+
+def count_key(announcement_id: int) -> str:
+    return f'favorites_count:{announcement_id}'
+
+
+async def publish_counts(db: AsyncSession, announcement_ids: Iterable[int]):
+    """
+    Makes the committed favorites_count of the announcements override the one of cached responses
+    """
+    announcement_ids = set(announcement_ids)
+    if not announcement_ids:
+        return
+    rows = await db.execute(select(models.Announcements.id, models.Announcements.favorites_count)
+                            .where(models.Announcements.id.in_(announcement_ids)))
+    await cache.response_cache.backend.set_many({count_key(id): count for id, count in rows}, COUNT_TTL)
+
+
+async def merge_counts(content, announcement_ids: List[int]):
+    """
+    Announcement content (one or a list, in the order of announcement_ids) with the counters published since
+    """
+    announcements = content if isinstance(content, list) else [content]
+    counts = await cache.response_cache.backend.get_many([count_key(id) for id in announcement_ids])
+    merged = [announcement if count is None else {**announcement, 'favorites_count': count}
+              for announcement, count in zip(announcements, counts)]
+    return merged if isinstance(content, list) else merged[0]
@@ -0,0 +1,52 @@
+"""
+Full-text search over announcement text.
+
+Backed by the InnoDB FULLTEXT index on announcements.text, so MySQL keeps the
+inverted index in sync on insert/update/delete and ranks matches itself.
+Words are reduced to a stem and searched as prefixes, which covers Russian
+inflections ("велосипеды", "велосипедом" -> "велосипед*").
+"""
+import os
+import re
+from typing import List
+
+from sqlalchemy.dialects.mysql import match
+
+import models
+
+# innodb_ft_min_token_size, shorter words are not indexed
+MIN_TOKEN_LENGTH = int(os.getenv('FT_MIN_TOKEN_SIZE', 3))
+MAX_TOKENS = 10
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# longest endings first
+RUSSIAN_ENDINGS = sorted([
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ией', 'иям', 'иях',
+    'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ый', 'ий', 'ой', 'ей', 'ую', 'юю', 'ом', 'ем',
+    'ам', 'ям', 'ах', 'ях', 'ов', 'ев', 'ия', 'ие', 'ии', 'ью',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+], key=len, reverse=True)
+
+
+def stem(word: str) -> str:
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_TOKEN_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(query: str) -> List[str]:
+    tokens = []
+    for word in TOKEN_RE.findall(query.lower()):
+        if len(word) >= MIN_TOKEN_LENGTH and stem(word) not in tokens:
+            tokens.append(stem(word))
+    return tokens[:MAX_TOKENS]
+
+
+def relevance(tokens: List[str]):
+    """
+    MATCH ... AGAINST expression in boolean mode without required operators: an announcement matches any
+    of the words and is ranked higher the more (and rarer) words it contains.
+    """
+    return match(models.Announcements.text, against=' '.join(f'{token}*' for token in tokens)).in_boolean_mode()
@@ -1,6 +1,25 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+import metrics
+
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', 2))
+# hashing calls allowed to wait for a free worker, the next ones are rejected with busy_exception
+HASH_QUEUE_LIMIT = int(os.getenv('HASH_QUEUE_LIMIT', 16))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+busy_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Too many password checks in progress, try again later",
+    headers={"Retry-After": "1"},
+)
 
 
 class Hash():
@@ -8,4 +27,53 @@ class Hash():
         return pwd_context.hash(password)
 
     def verify(hashed_password, plain_password):
-        return pwd_context.verify(plain_password, hashed_password)
\ No newline at end of file
+        return pwd_context.verify(plain_password, hashed_password)
+
+    def verify_and_update(hashed_password, plain_password):
+        """
+        (is the password valid, new hash if the stored one uses outdated settings else None)
+        """
+        return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
+_executor = None
+_in_flight = 0
+
+
+def get_executor():
+    # created on first use, so every server worker process gets its own pool
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+    return _executor
+
+
+async def run_in_pool(func, *args):
+    """
+    Runs CPU-bound bcrypt in the hashing process pool, so password checks only compete with each other
+    """
+    global _in_flight
+    if _in_flight >= HASH_WORKERS + HASH_QUEUE_LIMIT:
+        raise busy_exception
+    _in_flight += 1
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), func, *args)
+    finally:
+        _in_flight -= 1
+        metrics.task_seconds.observe(time.perf_counter() - started, task=func.__name__)
+
+
+async def hash_password(password: str):
+    return await run_in_pool(Hash.bcrypt, password)
+
+
+async def verify_password(hashed_password, plain_password):
+    return await run_in_pool(Hash.verify_and_update, hashed_password, plain_password)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -1,37 +1,125 @@
 from fastapi import FastAPI, status, Depends, HTTPException
+from fastapi.responses import PlainTextResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+import logging
+import os
+import time
 import uvicorn
 from Token_oath import create_access_token
-from routers import user, admin
-from hashing import Hash
+from routers import user, admin, events, images
+import hashing
+import oath
+import thumbnails
+import orphans
+import metrics
+import budgets
+import admission
+import outbox
+import price_stats
+import database
+import refdata
 from models import Users
-from database import get_db, engine, Base
+from database import get_db
+import migrations
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+app = FastAPI(dependencies=[Depends(admission.expensive_slot)])
+app.add_middleware(metrics.MetricsMiddleware)
 
 app.include_router(user.router)
 app.include_router(admin.router)
+app.include_router(events.router)
+app.include_router(images.router)
+
+
+# started in this order, stopped in the reverse one
+SERVICES = [
+    ('refdata', refdata.start, refdata.stop),
+    ('thumbnails', thumbnails.start, thumbnails.stop),
+    ('orphans', orphans.start, orphans.stop),
+    ('metrics', metrics.start, metrics.stop),
+    ('outbox', outbox.start, outbox.stop),
+    ('price_stats', price_stats.start, price_stats.stop),
+]
+# step -> seconds the last startup of this worker took for it
+startup_seconds = {}
+
+
+@app.on_event('startup')
+async def startup():
+    started = time.perf_counter()
+    database.connect()
+    for name, start, stop in SERVICES:
+        step_started = time.perf_counter()
+        await start()
+        startup_seconds[name] = time.perf_counter() - step_started
+    startup_seconds['total'] = time.perf_counter() - started
+    for name, seconds in startup_seconds.items():
+        metrics.startup_seconds.set(seconds, step=name)
+    logger.info('worker %s started in %.3f s (%s)', os.getpid(), startup_seconds['total'],
+                ', '.join(f'{name} {seconds:.3f} s' for name, seconds in startup_seconds.items() if name != 'total'))
 
 
-@app.post('/login', tags=['Login'])
-def login(request: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+@app.on_event('shutdown')
+async def shutdown():
+    for name, start, stop in reversed(SERVICES):
+        await stop()
+    hashing.shutdown()
+    await database.disconnect()
+
+
+@app.post('/login', tags=['Login'], dependencies=[Depends(admission.admit_client)])
+@budgets.query_budget(2, rows=1)
+@admission.cost(10)
+async def login(request: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     """
     login route
     """
 
-    user = db.query(Users).filter(Users.email == request.username).first()
+    user = (await db.execute(select(Users).where(Users.email == request.username))).scalars().first()
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Invalid Credentials")
-    if not Hash.verify(user.password_hash, request.password):
+    valid, new_hash = await hashing.verify_password(user.password_hash, request.password)
+    if not valid:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Incorrect password")
+    if new_hash:
+        user.password_hash = new_hash
+        await db.commit()
 
-    access_token = create_access_token(data={"sub": user.email})
+    access_token = create_access_token(data={"sub": user.email, "uid": user.id, "ver": user.token_version})
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+@app.post('/logout', tags=['Login'])
+@budgets.query_budget(1, rows=0)
+async def logout(db: AsyncSession = Depends(get_db), current_user_id: int = Depends(oath.get_current_user_id)):
+    """
+    revokes every access token of the user
+    """
+
+    await oath.revoke_tokens(db, current_user_id)
+    await db.commit()
+    return {"detail": "logged out"}
+
+
+
+@app.get('/metrics', response_class=PlainTextResponse, include_in_schema=False)
+@budgets.query_budget(0)
+async def show_metrics():
+    """
+    metrics of this worker process in the Prometheus text format
+    """
+
+    return PlainTextResponse(metrics.render(database.pool_status()), media_type='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
-    Base.metadata.create_all(bind=engine)
+    # single process development server, production: serve.py
+    asyncio.run(migrations.bootstrap())
     uvicorn.run(app, host='127.0.0.1', port=8000)
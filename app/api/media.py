@@ -0,0 +1,191 @@
+"""
+Serving of stored images.
+
+Where an image is on disk is looked up once and kept in `image_files` for
+IMAGE_CACHE_TTL seconds, so a hot image costs a stat() and no query. Entries
+looked up by image id are kept for IMAGE_ID_CACHE_TTL only: deleting an image
+row forgets them in the deleting worker (forget_images), the other workers
+serve the file until they expire. Files are
+content-addressed and never change, hence the strong ETag from the content
+hash and the immutable Cache-Control. The one exception is a resized version
+that is not rendered yet: the original is served meanwhile, with a short
+max-age and not cached here for long.
+
+ImageFileResponse answers single byte ranges and sends the file through the
+server's zero-copy extension (http.response.zerocopysend) when the server
+offers it, or in CHUNK_SIZE reads otherwise.
+"""
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+from typing import Iterable, Optional, Tuple
+
+import anyio
+from sqlalchemy import and_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.responses import Response
+
+import models
+import schemas
+import storage
+from cache import TTLCache
+
+IMAGE_CACHE_TTL = int(os.getenv('IMAGE_CACHE_TTL', 3600))
+IMAGE_CACHE_SIZE = int(os.getenv('IMAGE_CACHE_SIZE', 100000))
+IMAGE_ID_CACHE_TTL = int(os.getenv('IMAGE_ID_CACHE_TTL', 60))
+# while a resized version is not rendered yet
+PROVISIONAL_TTL = 60
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+PROVISIONAL = f'public, max-age={PROVISIONAL_TTL}'
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# (key, size) -> (path, etag or None, final)
+image_files = TTLCache(ttl=IMAGE_CACHE_TTL, maxsize=IMAGE_CACHE_SIZE)
+
+
+async def lookup(db: AsyncSession, condition, image_size: schemas.Image_size):
+    """
+    (path, etag, final) of the image matching the condition, final is False while the original stands in
+    for a resized version that is not rendered yet. None if there is no such image.
+    """
+    columns = [models.Images.data_path, models.Images.content_hash]
+    query = select(*columns)
+    if image_size != schemas.Image_size.original:
+        query = select(*columns, models.ImageDerivatives.data_path).outerjoin(
+            models.ImageDerivatives,
+            and_(models.ImageDerivatives.image_id == models.Images.id,
+                 models.ImageDerivatives.size == image_size.value))
+    row = (await db.execute(query.where(condition).limit(1))).first()
+    if row is None:
+        return None
+    path, content_hash, *derivative = row
+    etag = f'"{content_hash}"' if content_hash else None
+    if image_size == schemas.Image_size.original:
+        return path, etag, True
+    if derivative[0] is None:
+        return path, etag, False
+    return derivative[0], etag and f'"{content_hash}-{image_size.value}"', True
+
+
+async def find(key, image_size: schemas.Image_size, load, ttl: float = IMAGE_CACHE_TTL):
+    """
+    Cached lookup, `load()` is awaited on a miss
+    """
+    info = image_files.get((key, image_size))
+    if info is None:
+        info = await load()
+        if info is not None:
+            image_files.set((key, image_size), info, ttl if info[2] else min(ttl, PROVISIONAL_TTL))
+    return info
+
+
+def forget(key, image_size: schemas.Image_size):
+    image_files.delete((key, image_size))
+
+
+def forget_images(image_ids: Iterable[int]):
+    """
+    Drops every size of the images looked up by id, once their rows are deleted
+    """
+    for image_id in image_ids:
+        for image_size in schemas.Image_size:
+            forget(image_id, image_size)
+
+
+def byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    (first, last) byte of a single range Range header, None to send the whole file.
+    Raises ValueError for a range outside of the file.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        raise ValueError(header)
+    return first, last
+
+
+def not_modified(headers, etag: str, stat_result: os.stat_result) -> bool:
+    if_none_match = headers.get('if-none-match')
+    if if_none_match is not None:
+        return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+    if_modified_since = headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class ImageFileResponse(Response):
+    """
+    Whole file, or bytes first..last of it with 206, of the stat()ed file at path
+    """
+
+    def __init__(self, path: str, stat_result: os.stat_result, headers: dict, method: str = 'GET',
+                 first: Optional[int] = None, last: Optional[int] = None):
+        self.path = path
+        self.send_header_only = method == 'HEAD'
+        size = stat_result.st_size
+        if first is None:
+            self.offset, self.count = 0, size
+            self.status_code = 200
+        else:
+            self.offset, self.count = first, last - first + 1
+            self.status_code = 206
+            headers = {**headers, 'Content-Range': f'bytes {first}-{last}/{size}'}
+        self.media_type = guess_type(path)[0] or 'application/octet-stream'
+        self.background = None
+        self.init_headers({**headers, 'Content-Length': str(self.count)})
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if self.send_header_only or not self.count:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+        if 'http.response.zerocopysend' in scope.get('extensions', {}):
+            with open(self.path, 'rb') as file:
+                await send({'type': 'http.response.zerocopysend', 'file': file,
+                            'offset': self.offset, 'count': self.count, 'more_body': False})
+            return
+        async with await anyio.open_file(self.path, 'rb') as file:
+            await file.seek(self.offset)
+            remaining = self.count
+            while remaining:
+                chunk = await file.read(min(storage.CHUNK_SIZE, remaining))
+                remaining = remaining - len(chunk) if chunk else 0
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': bool(remaining)})
+
+
+def respond(request, path: str, etag: Optional[str], final: bool, stat_result: os.stat_result) -> Response:
+    """
+    304, 206, 416 or 200 response to the request for the file
+    """
+    etag = etag or f'"{int(stat_result.st_mtime)}-{stat_result.st_size}"'
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': last_modified,
+        'Cache-Control': IMMUTABLE if final else PROVISIONAL,
+        'Accept-Ranges': 'bytes',
+    }
+    if not_modified(request.headers, etag, stat_result):
+        return Response(status_code=304, headers=headers)
+    first = last = None
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header and (if_range is None or if_range.strip() in (etag, last_modified)):
+        try:
+            first, last = byte_range(range_header, stat_result.st_size) or (None, None)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{stat_result.st_size}'})
+    return ImageFileResponse(path, stat_result, headers, request.method, first, last)
@@ -0,0 +1,270 @@
+"""
+Request-level performance metrics in the Prometheus text format.
+
+MetricsMiddleware times every request and counts the SQL statements it runs, their
+time and the rows they return (cursor events of every engine), and the size of the
+response, per route. monitor_lag() measures how late the event loop and the thread
+pool pick up work. Everything is rendered by render() for GET /metrics; requests
+slower than SLOW_REQUEST_SECONDS are logged with the SQL they ran, and the
+statements and rows are checked against the query budget of the route.
+
+Metrics live in the process: with several server workers every worker reports its own.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.concurrency import run_in_threadpool
+
+import budgets
+
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 1))
+# statements kept per request for the slow request log
+CAPTURED_STATEMENTS = 50
+LAG_CHECK_INTERVAL = 1.0
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> (per bucket counts, sum, count)
+        self._series = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        counts, total, count = self._series.get(key) or ([0] * len(self.buckets), 0.0, 0)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self._series[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for key, (counts, total, count) in self._series.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket{format_labels(key + (("le", bound),))} {bucket_count}'
+            yield f'{self.name}_bucket{format_labels(key + (("le", "+Inf"),))} {count}'
+            yield f'{self.name}_sum{format_labels(key)} {total}'
+            yield f'{self.name}_count{format_labels(key)} {count}'
+
+
+class Counter:
+    def __init__(self, name: str, help: str, type: str = 'counter'):
+        self.name = name
+        self.help = help
+        self.type = type
+        self._series = defaultdict(float)
+
+    def inc(self, value: float = 1, **labels):
+        self._series[tuple(sorted(labels.items()))] += value
+
+    def set(self, value: float, **labels):
+        self._series[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        for key, value in self._series.items():
+            yield f'{self.name}{format_labels(key)} {value}'
+
+
+class Gauge(Counter):
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help, 'gauge')
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ''
+    values = ','.join(f'{name}="{escape(value)}"' for name, value in labels)
+    return f'{{{values}}}'
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_seconds = Histogram('http_request_duration_seconds', 'Request latency', LATENCY_BUCKETS)
+request_statements = Histogram('http_request_sql_statements', 'SQL statements per request', STATEMENT_BUCKETS)
+response_bytes = Histogram('http_response_size_bytes', 'Response body size', SIZE_BUCKETS)
+sql_seconds = Counter('http_request_sql_seconds_total', 'Time spent in SQL statements')
+sql_rows = Counter('http_request_sql_rows_total', 'Rows returned by SQL statements')
+task_seconds = Histogram('task_duration_seconds', 'Time of offloaded CPU-bound work, queueing included',
+                         LATENCY_BUCKETS)
+loop_lag = Gauge('event_loop_lag_seconds', 'How late the last event loop check ran')
+threadpool_lag = Gauge('threadpool_lag_seconds', 'How long the last thread pool check waited to start')
+startup_seconds = Gauge('startup_duration_seconds', 'Time the startup steps of this worker took')
+rejected_requests = Counter('http_requests_rejected_total', 'Requests refused by admission control')
+pool_gauges = {
+    name: Gauge(f'db_pool_{name}', f'Connection pool {name.replace("_", " ")}')
+    for name in ('size', 'checked_out', 'checked_in', 'overflow')
+}
+pool_counters = {
+    name: Counter(f'db_pool_{name}_total', f'Connection pool {name.replace("_", " ")}')
+    for name in ('connects', 'checkouts', 'timeouts', 'invalidations', 'wait_seconds')
+}
+METRICS = [request_seconds, request_statements, response_bytes, sql_seconds, sql_rows, task_seconds,
+           loop_lag, threadpool_lag, startup_seconds, rejected_requests, *pool_gauges.values(),
+           *pool_counters.values()]
+
+
+class RequestStats:
+    def __init__(self):
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        # charged to the query budget of the route, see budgets.py
+        self.budgeted_statements = 0
+        self.budgeted_rows = 0
+        self.captured = []
+        self.budgeted_captured = []
+
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(exception_context):
+    if exception_context.connection is not None and exception_context.connection.info.get('query_started'):
+        exception_context.connection.info['query_started'].pop()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    stats = current_request.get()
+    if stats is None:
+        return
+    rows = 0
+    # -1 or a huge unsigned value when the driver doesn't know it, e.g. for server-side cursors
+    if cursor.description is not None and 0 <= cursor.rowcount < 2 ** 32:
+        rows = cursor.rowcount
+    captured = (round(elapsed * 1000, 2), ' '.join(statement.split())[:1000])
+    stats.statements += 1
+    stats.sql_seconds += elapsed
+    stats.rows += rows
+    if len(stats.captured) < CAPTURED_STATEMENTS:
+        stats.captured.append(captured)
+    if not budgets.is_unbudgeted():
+        stats.budgeted_statements += 1
+        stats.budgeted_rows += rows
+        if len(stats.budgeted_captured) < CAPTURED_STATEMENTS:
+            stats.budgeted_captured.append(captured)
+
+
+_route_paths = {}
+
+
+def route_path(scope) -> str:
+    """
+    Path template of the matched route, so /announcements/1 and /announcements/2 share their metrics
+    """
+    endpoint = scope.get('endpoint')
+    if endpoint is None:
+        return 'unmatched'
+    if endpoint not in _route_paths:
+        routes = getattr(scope.get('app'), 'routes', [])
+        _route_paths[endpoint] = next((route.path for route in routes if getattr(route, 'endpoint', None) is endpoint),
+                                      'unmatched')
+    return _route_paths[endpoint]
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                size += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+            budgets.check(scope['method'], scope['path'], scope.get('endpoint'), stats.budgeted_statements,
+                          stats.budgeted_rows, stats.budgeted_captured)
+        finally:
+            current_request.reset(token)
+            elapsed = time.perf_counter() - started
+            labels = {'method': scope['method'], 'route': route_path(scope)}
+            request_seconds.observe(elapsed, status=status, **labels)
+            request_statements.observe(stats.statements, **labels)
+            response_bytes.observe(size, **labels)
+            sql_seconds.inc(stats.sql_seconds, **labels)
+            sql_rows.inc(stats.rows, **labels)
+            if elapsed >= SLOW_REQUEST_SECONDS:
+                logger.warning('slow request %s %s: %.3fs, %d SQL statements in %.3fs, %d rows, %d bytes\n%s',
+                               scope['method'], scope['path'], elapsed, stats.statements, stats.sql_seconds,
+                               stats.rows, size,
+                               '\n'.join(f'  {ms} ms: {statement}' for ms, statement in stats.captured))
+
+
+async def monitor_lag():
+    """
+    Records how late a sleep of the event loop wakes up and how long a thread pool call waits to start
+    """
+    while True:
+        expected = time.perf_counter() + LAG_CHECK_INTERVAL
+        await asyncio.sleep(LAG_CHECK_INTERVAL)
+        loop_lag.set(max(time.perf_counter() - expected, 0))
+        submitted = time.perf_counter()
+        threadpool_lag.set(await run_in_threadpool(time.perf_counter) - submitted)
+
+
+def render(pool_status: dict) -> str:
+    """
+    All metrics in the text exposition format, pool_status as returned by database.pool_status()
+    """
+    for engine_name, status in pool_status.items():
+        for name, gauge in pool_gauges.items():
+            gauge.set(status[name], engine=engine_name)
+        for name, counter in pool_counters.items():
+            counter.set(status['wait_seconds_total' if name == 'wait_seconds' else name], engine=engine_name)
+    return '\n'.join(line for metric in METRICS for line in metric.render()) + '\n'
+
+
+_task = None
+
+
+async def start():
+    global _task
+    _task = asyncio.create_task(monitor_lag())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
@@ -0,0 +1,141 @@
+"""
+Schema bootstrap and migrations.
+
+A fresh database is created from the models and stamped with every migration,
+an existing one gets the pending migrations applied in order:
+
+    python migrations.py
+"""
+import asyncio
+
+from sqlalchemy import Column, DATETIME, MetaData, Table, VARCHAR, inspect, text
+from sqlalchemy.sql import func
+
+import database
+from database import Base
+import models
+
+MIGRATIONS = [
+    ('0001_announcements_created_at_id', [
+        'CREATE INDEX ix_announcements_created_at_id ON announcements (created_at, id)',
+    ]),
+    ('0002_announcements_text_fulltext', [
+        'CREATE FULLTEXT INDEX ix_announcements_text_fulltext ON announcements (text)',
+    ]),
+    ('0003_announcements_filter_indexes', [
+        'CREATE INDEX ix_announcements_town_category_created_at ON announcements (town_id, category_id, created_at)',
+        'CREATE INDEX ix_announcements_category_price ON announcements (category_id, price)',
+        'CREATE INDEX ix_announcements_user_created_at ON announcements (user_id, created_at)',
+    ]),
+    ('0004_users_token_version', [
+        'ALTER TABLE users ADD COLUMN token_version INT NOT NULL DEFAULT 0',
+    ]),
+    ('0005_images_content_hash', [
+        'ALTER TABLE images ADD COLUMN content_hash VARCHAR(64) NULL',
+        'CREATE INDEX ix_images_content_hash ON images (content_hash)',
+    ]),
+    ('0006_image_derivatives', [
+        'CREATE TABLE image_derivatives ('
+        ' id INTEGER NOT NULL AUTO_INCREMENT,'
+        ' image_id INTEGER NOT NULL,'
+        ' size VARCHAR(16) NOT NULL,'
+        ' data_path TEXT NOT NULL,'
+        ' PRIMARY KEY (id),'
+        ' CONSTRAINT uq_image_derivatives_image_id_size UNIQUE (image_id, size),'
+        ' FOREIGN KEY(image_id) REFERENCES images (id) ON DELETE cascade)',
+        'CREATE INDEX ix_image_derivatives_id ON image_derivatives (id)',
+    ]),
+    ('0007_reference_versions', [
+        'CREATE TABLE reference_versions ('
+        ' name VARCHAR(32) NOT NULL,'
+        ' version INTEGER NOT NULL,'
+        ' PRIMARY KEY (name))',
+    ]),
+    ('0008_favorites_per_user', [
+        # the foreign key needs an index on announcement_id before the unique one can go
+        'CREATE INDEX ix_favorites_announcement_id ON favorites (announcement_id)',
+        'ALTER TABLE favorites DROP INDEX announcement_id',
+        'CREATE UNIQUE INDEX uq_favorites_user_id_announcement_id ON favorites (user_id, announcement_id)',
+        'ALTER TABLE announcements ADD COLUMN favorites_count INT NOT NULL DEFAULT 0',
+        'UPDATE announcements SET favorites_count ='
+        ' (SELECT COUNT(*) FROM favorites WHERE favorites.announcement_id = announcements.id)',
+    ]),
+    ('0009_outbox', [
+        'CREATE TABLE outbox_events ('
+        ' id INTEGER NOT NULL AUTO_INCREMENT,'
+        ' event VARCHAR(32) NOT NULL,'
+        ' announcement_id INTEGER NOT NULL,'
+        ' payload TEXT NOT NULL,'
+        ' created_at DATETIME NOT NULL DEFAULT now(),'
+        ' PRIMARY KEY (id))',
+        'CREATE INDEX ix_outbox_events_created_at ON outbox_events (created_at)',
+        'CREATE TABLE consumer_offsets ('
+        ' consumer VARCHAR(64) NOT NULL,'
+        ' position INTEGER NOT NULL,'
+        ' PRIMARY KEY (consumer))',
+    ]),
+    ('0010_price_buckets', [
+        'CREATE TABLE price_buckets ('
+        ' town_id INTEGER NOT NULL,'
+        ' category_id INTEGER NOT NULL,'
+        ' bucket INTEGER NOT NULL,'
+        ' announcements_count INTEGER NOT NULL,'
+        ' price_sum DOUBLE NOT NULL,'
+        ' PRIMARY KEY (town_id, category_id, bucket))',
+        # same buckets as price_stats.bucket_of
+        'INSERT INTO price_buckets (town_id, category_id, bucket, announcements_count, price_sum)'
+        ' SELECT town_id, category_id, CASE WHEN price < 1 THEN 0 ELSE FLOOR(LN(price) / LN(1.05)) + 1 END AS b,'
+        ' COUNT(*), SUM(price) FROM announcements GROUP BY town_id, category_id, b',
+    ]),
+    ('0011_announcements_price_double', [
+        'ALTER TABLE announcements MODIFY price DOUBLE NOT NULL',
+    ]),
+    ('0012_announcements_import_batch', [
+        'ALTER TABLE announcements ADD COLUMN import_batch VARCHAR(32) NULL',
+        'CREATE INDEX ix_announcements_import_batch ON announcements (import_batch)',
+    ]),
+]
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', VARCHAR(100), primary_key=True),
+    Column('applied_at', DATETIME, server_default=func.now(), nullable=False),
+)
+
+
+def _upgrade(conn):
+    fresh = not inspect(conn).has_table(models.Announcements.__tablename__)
+    schema_migrations.create(conn, checkfirst=True)
+    if fresh:
+        # the models already have every migration in them
+        Base.metadata.create_all(bind=conn)
+    applied = {row.version for row in conn.execute(schema_migrations.select())}
+    for version, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        if not fresh:
+            for statement in statements:
+                conn.execute(text(statement))
+        conn.execute(schema_migrations.insert().values(version=version))
+    if not fresh:
+        # only after the migrations, which create their tables themselves (and fill them)
+        Base.metadata.create_all(bind=conn)
+
+
+async def upgrade(bind=None):
+    async with (bind or database.connect()).begin() as conn:
+        await conn.run_sync(_upgrade)
+
+
+async def bootstrap():
+    """
+    One-shot upgrade outside of the server's event loop, pooled connections are closed afterwards
+    """
+    try:
+        await upgrade()
+    finally:
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(bootstrap())
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, DATETIME, Float, Text, VARCHAR, BigInteger
+from sqlalchemy import Column, ForeignKey, Integer, String, DATETIME, Float, Text, VARCHAR, BigInteger, Index, \
+    UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import EmailType
 from sqlalchemy.sql import func
@@ -15,11 +16,13 @@ class Users(Base):
     mobile_phone = Column(BigInteger, nullable=False, unique=True)
     town_id = Column(Integer, ForeignKey('towns.id'), nullable=False)
     password_hash = Column(VARCHAR(100), nullable=False)
+    # embedded in access tokens, incremented to revoke all of them
+    token_version = Column(Integer, nullable=False, default=0, server_default='0')
     created_at = Column(DATETIME(timezone=True), server_default=func.now(), nullable=False)
 
-    announcement = relationship('Announcements', lazy='joined', back_populates='user')
-    favorite = relationship('Favorites', lazy='joined', back_populates='user')
-    town = relationship('Towns', lazy='joined', back_populates='user')
+    announcement = relationship('Announcements', lazy='select', back_populates='user')
+    favorite = relationship('Favorites', lazy='select', back_populates='user')
+    town = relationship('Towns', lazy='select', back_populates='user')
 
 
 class Towns(Base):
@@ -28,26 +31,38 @@ class Towns(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     town_name = Column(VARCHAR(100), nullable=False, unique=True)
 
-    user = relationship('Users', lazy='joined', back_populates='town')
-    announcement = relationship('Announcements', lazy='joined', back_populates='town')
+    user = relationship('Users', lazy='select', back_populates='town')
+    announcement = relationship('Announcements', lazy='select', back_populates='town')
 
 
 class Announcements(Base):
     __tablename__ = 'announcements'
+    __table_args__ = (
+        Index('ix_announcements_created_at_id', 'created_at', 'id'),
+        Index('ix_announcements_text_fulltext', 'text', mysql_prefix='FULLTEXT'),
+        Index('ix_announcements_town_category_created_at', 'town_id', 'category_id', 'created_at'),
+        Index('ix_announcements_category_price', 'category_id', 'price'),
+        Index('ix_announcements_user_created_at', 'user_id', 'created_at'),
+    )
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id', ondelete='cascade'), nullable=False)
-    price = Column(Float, nullable=False)
+    # double precision, so price_stats subtracts exactly what it added
+    price = Column(Float(precision=53), nullable=False)
     category_id = Column(Integer, ForeignKey('categories.id'), nullable=False)
     text = Column(Text, nullable=False)
     town_id = Column(Integer, ForeignKey('towns.id'), nullable=False)
     created_at = Column(DATETIME(timezone=True), server_default=func.now(), nullable=False)
+    # number of favorites rows of the announcement, kept up to date by favorites.refresh_counts
+    favorites_count = Column(Integer, nullable=False, default=0, server_default='0')
+    # random id of the bulk import batch that inserted the row, bulk.insert_batch reads the batch back by it
+    import_batch = Column(String(32), index=True)
 
-    user = relationship('Users', lazy='joined', back_populates='announcement')
-    category = relationship('Categories', lazy='joined', back_populates='announcement')
-    town = relationship('Towns', lazy='joined', back_populates='announcement')
-    image = relationship('Images', lazy='joined', back_populates='announcement')
-    favorite = relationship('Favorites', lazy='joined', back_populates='announcement')
+    user = relationship('Users', lazy='select', back_populates='announcement')
+    category = relationship('Categories', lazy='select', back_populates='announcement')
+    town = relationship('Towns', lazy='select', back_populates='announcement')
+    image = relationship('Images', lazy='select', back_populates='announcement', order_by='Images.id')
+    favorite = relationship('Favorites', lazy='select', back_populates='announcement')
 
 
 class Images(Base):
@@ -56,20 +71,41 @@ class Images(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     announcement_id = Column(Integer, ForeignKey('announcements.id', ondelete='cascade'), nullable=False)
     data_path = Column(Text, nullable=False)
+    # sha256 of the file, files are shared between rows with equal content
+    content_hash = Column(String(64), index=True)
 
-    announcement = relationship('Announcements', lazy='joined', back_populates='image')
+    announcement = relationship('Announcements', lazy='select', back_populates='image')
+    derivative = relationship('ImageDerivatives', lazy='select', back_populates='image')
+
+
+class ImageDerivatives(Base):
+    __tablename__ = 'image_derivatives'
+    __table_args__ = (
+        UniqueConstraint('image_id', 'size', name='uq_image_derivatives_image_id_size'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    image_id = Column(Integer, ForeignKey('images.id', ondelete='cascade'), nullable=False)
+    size = Column(VARCHAR(16), nullable=False)
+    data_path = Column(Text, nullable=False)
+
+    image = relationship('Images', lazy='select', back_populates='derivative')
 
 
 class Favorites(Base):
     __tablename__ = 'favorites'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'announcement_id', name='uq_favorites_user_id_announcement_id'),
+        Index('ix_favorites_announcement_id', 'announcement_id'),
+    )
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id', ondelete='cascade'), nullable=False)
-    announcement_id = Column(Integer, ForeignKey('announcements.id', ondelete='cascade'), nullable=False, unique=True)
+    announcement_id = Column(Integer, ForeignKey('announcements.id', ondelete='cascade'), nullable=False)
     created_at = Column(DATETIME(timezone=True), server_default=func.now(), nullable=False)
 
-    user = relationship('Users', lazy='joined', back_populates='favorite')
-    announcement = relationship('Announcements', lazy='joined', back_populates='favorite')
+    user = relationship('Users', lazy='select', back_populates='favorite')
+    announcement = relationship('Announcements', lazy='select', back_populates='favorite')
 
 
 class Categories(Base):
@@ -78,4 +114,41 @@ class Categories(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     category_name = Column(VARCHAR(100), nullable=False, unique=True)
 
-    announcement = relationship('Announcements', lazy='joined', back_populates='category')
+    announcement = relationship('Announcements', lazy='select', back_populates='category')
+
+
+class ReferenceVersions(Base):
+    __tablename__ = 'reference_versions'
+
+    name = Column(VARCHAR(32), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class OutboxEvents(Base):
+    __tablename__ = 'outbox_events'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # announcement.created, announcement.updated, announcement.deleted
+    event = Column(VARCHAR(32), nullable=False)
+    announcement_id = Column(Integer, nullable=False)
+    payload = Column(Text, nullable=False)
+    created_at = Column(DATETIME(timezone=True), server_default=func.now(), nullable=False, index=True)
+
+
+class ConsumerOffsets(Base):
+    __tablename__ = 'consumer_offsets'
+
+    consumer = Column(VARCHAR(64), primary_key=True)
+    # id of the last outbox event the consumer has processed
+    position = Column(Integer, nullable=False, default=0)
+
+
+class PriceBuckets(Base):
+    __tablename__ = 'price_buckets'
+
+    # announcements of the town and category with a price in the bucket, see price_stats.py
+    town_id = Column(Integer, primary_key=True, autoincrement=False)
+    category_id = Column(Integer, primary_key=True, autoincrement=False)
+    bucket = Column(Integer, primary_key=True, autoincrement=False)
+    announcements_count = Column(Integer, nullable=False, default=0)
+    price_sum = Column(Float(precision=53), nullable=False, default=0)
@@ -1,14 +1,23 @@
-from fastapi import Depends, HTTPException, status
+import os
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from Token_oath import verify_token, SECRET_KEY, ALGORITHM
 from models import Users
-from database import get_db
+from database import SessionLocal
 from schemas import TokenData
+from cache import TTLCache
+import budgets
+import admission
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# user id -> current token version; a revocation reaches other workers within this many seconds
+TOKEN_VERSION_TTL = int(os.getenv('TOKEN_VERSION_TTL', 30))
+token_versions = TTLCache(ttl=TOKEN_VERSION_TTL)
+
 credentials_exception = HTTPException(
     status_code=status.HTTP_401_UNAUTHORIZED,
     detail="Could not validate credentials",
@@ -25,16 +34,38 @@ def get_user_id(db, email: str):
         return db.query(Users).filter(Users.email == email)
 
 
-def get_current_user_id(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
+async def get_token_version(user_id: int):
+    version = token_versions.get(user_id)
+    if version is None:
+        with budgets.unbudgeted():
+            async with SessionLocal() as db:
+                version = (await db.execute(select(Users.token_version).where(Users.id == user_id))).scalar()
+        if version is not None:
+            token_versions.set(user_id, version)
+    return version
+
+
+async def revoke_tokens(db: AsyncSession, user_id: int):
+    """
+    Invalidates every token issued to the user so far, takes effect with the commit of `db`
+    """
+    await db.execute(update(Users).where(Users.id == user_id).values(token_version=Users.token_version + 1))
+    token_versions.delete(user_id)
+
+
+async def get_current_user_id(request: Request, token: str = Depends(oauth2_scheme)):
+    """
+    Identity comes from the token itself, the database is asked only for the token version
+    of users missing from token_versions. The request is then charged to the user's rate limit.
+    """
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(name=username)
+        token_data = TokenData(name=payload.get("sub"), user_id=payload.get("uid"), version=payload.get("ver"))
     except JWTError:
         raise credentials_exception
-    user = db.query(Users).filter(Users.email == token_data.name).first()
-    if user is None:
+    if token_data.user_id is None or token_data.version is None:
+        raise credentials_exception
+    if await get_token_version(token_data.user_id) != token_data.version:
         raise credentials_exception
-    return user.id
\ No newline at end of file
+    await admission.admit(request, f'user:{token_data.user_id}')
+    return token_data.user_id
@@ -0,0 +1,172 @@
+"""
+Removal of image files that no row references any more.
+
+Deleting announcements and users only commits the rows and puts the paths of
+their originals and derivatives on `queue`; the worker removes the ones that
+are no longer referenced (files are shared by content). Files that never reach
+the worker (a full queue, a restart, a cascade from elsewhere) are reclaimed by
+collect(), which walks MEDIA_ROOT in GC_BATCH_SIZE batches and removes files
+older than GC_MIN_AGE that no row points to, .part files left by crashed
+uploads and renders included. It runs every GC_INTERVAL seconds in each server
+process (GET_LOCK keeps two collections from overlapping), or once with
+`python orphans.py`.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Iterable, Iterator, List, Optional
+
+from sqlalchemy import select, text, union_all
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import iterate_in_threadpool
+
+import database
+import models
+import storage
+from tasks import TaskQueue
+
+logger = logging.getLogger(__name__)
+
+# seconds between two collections, 0 disables the periodic collection
+GC_INTERVAL = float(os.getenv('ORPHAN_GC_INTERVAL', 6 * 3600))
+GC_BATCH_SIZE = int(os.getenv('ORPHAN_GC_BATCH_SIZE', 1000))
+# younger files may belong to an upload whose rows are not committed yet
+GC_MIN_AGE = float(os.getenv('ORPHAN_GC_MIN_AGE', 3600))
+# files reused by an upload this recently are left to the collection
+REUSE_GRACE = 300
+GC_LOCK = 'orphaned_files_collection'
+
+
+async def announcement_files(db: AsyncSession, *conditions) -> List[str]:
+    """
+    Paths of the originals and derivatives of the images of the announcements matching the conditions
+    """
+    originals = select(models.Images.data_path).join(models.Images.announcement).where(*conditions)
+    derivatives = (select(models.ImageDerivatives.data_path)
+                   .join(models.ImageDerivatives.image)
+                   .join(models.Images.announcement)
+                   .where(*conditions))
+    rows = await db.execute(union_all(originals, derivatives))
+    return rows.scalars().all()
+
+
+async def image_ids(db: AsyncSession, *conditions) -> List[int]:
+    """
+    Ids of the images of the announcements matching the conditions
+    """
+    rows = await db.execute(select(models.Images.id).join(models.Images.announcement).where(*conditions))
+    return rows.scalars().all()
+
+
+async def remove_unreferenced(paths: List[str]) -> int:
+    async with database.SessionLocal() as db:
+        referenced = await storage.referenced(db, paths)
+    removable = [path for path in paths if path not in referenced]
+    await storage.remove_files(removable, min_age=REUSE_GRACE)
+    return len(removable)
+
+
+queue = TaskQueue('file removal', remove_unreferenced)
+
+
+def enqueue(paths: Iterable[str]):
+    """
+    Schedules removal of the files, to be called after the rows referencing them are committed
+    """
+    paths = list(paths)
+    for start in range(0, len(paths), GC_BATCH_SIZE):
+        queue.put(paths[start:start + GC_BATCH_SIZE])
+
+
+def _old_files(root, min_age: float) -> Iterator[List[str]]:
+    deadline = time.time() - min_age
+    batch = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            # temporary .part files of crashed uploads and renders are collected too, once older than min_age
+            if name.startswith('.'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                if os.stat(path).st_mtime > deadline:
+                    continue
+            except FileNotFoundError:
+                continue
+            batch.append(path)
+            if len(batch) >= GC_BATCH_SIZE:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+async def collect(min_age: float = GC_MIN_AGE) -> int:
+    """
+    Removes the files of MEDIA_ROOT no row references, returns their number
+    """
+    removed = 0
+    async for paths in iterate_in_threadpool(_old_files(storage.MEDIA_ROOT, min_age)):
+        removed += await remove_unreferenced(paths)
+    return removed
+
+
+async def collect_exclusively(min_age: float = GC_MIN_AGE) -> Optional[int]:
+    """
+    collect() unless another process is collecting, None then
+    """
+    async with database.engine.connect() as conn:
+        locked = (await conn.execute(text('SELECT GET_LOCK(:name, 0)'), {'name': GC_LOCK})).scalar()
+        # the lock is held by the session, not by the transaction the SELECT began
+        await conn.commit()
+        if not locked:
+            return None
+        try:
+            return await collect(min_age)
+        finally:
+            await conn.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': GC_LOCK})
+            await conn.commit()
+
+
+async def _collect_periodically():
+    while True:
+        await asyncio.sleep(GC_INTERVAL)
+        try:
+            removed = await collect_exclusively()
+            if removed is not None:
+                logger.info('removed %d orphaned files', removed)
+        except SQLAlchemyError:
+            logger.exception('orphaned files collection failed')
+
+
+_task = None
+
+
+async def start():
+    global _task
+    queue.start()
+    if GC_INTERVAL > 0:
+        _task = asyncio.create_task(_collect_periodically())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    await queue.stop()
+
+
+async def main():
+    database.connect()
+    try:
+        removed = await collect_exclusively()
+        print('another process is collecting' if removed is None else f'removed {removed} orphaned files')
+    finally:
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
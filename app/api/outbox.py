@@ -0,0 +1,204 @@
+"""
+Transactional outbox of announcement changes.
+
+Handlers that create, update or delete announcements call record() before their
+commit, so an event exists if and only if the change was committed. Events are
+read in id order from two sides:
+
+- in-process consumers registered with register(name, handler): the dispatcher
+  passes them batches of new events and stores how far each one got in
+  consumer_offsets. The offset row is locked while a batch is handled, so with
+  several server workers a consumer still sees every batch once at a time;
+  delivery is at least once, handlers must be idempotent.
+- external consumers, through routers/events.py (long-poll and SSE), with their
+  offsets kept in the same table under external_consumer() names: prefixed
+  with the id of the user owning them, so a user moves neither the offsets of
+  other users nor those of the in-process consumers.
+
+Readers advance by event id, so ids must be committed in increasing order.
+AUTO_INCREMENT alone doesn't ensure that: a transaction can take id N and
+commit after the one with id N + 1, whose readers would then skip N for good.
+record() therefore first bumps the SEQUENCE_NAME row of reference_versions,
+whose row lock is held until commit: transactions with events insert and
+commit them one at a time, in id order.
+
+Events older than OUTBOX_RETENTION_DAYS are pruned.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Iterable, List
+
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import database
+import models
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 500))
+# seconds between two checks for events written by other workers
+DISPATCH_INTERVAL = float(os.getenv('OUTBOX_DISPATCH_INTERVAL', 1))
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', 7))
+PRUNE_INTERVAL = 3600
+
+CREATED = 'announcement.created'
+UPDATED = 'announcement.updated'
+DELETED = 'announcement.deleted'
+# reference_versions row counting the transactions that recorded events
+SEQUENCE_NAME = 'outbox'
+EXTERNAL_PREFIX = 'user:'
+# longest name of an external consumer, its prefix and the user id fill the rest of the 64 characters
+EXTERNAL_NAME_LENGTH = 40
+
+consumers = {}
+_changed = None
+_task = None
+
+
+async def record(db: AsyncSession, event: str, announcements: Iterable[dict]):
+    """
+    Adds an event per announcement to the transaction of `db`, every dict must have the 'id' of the announcement.
+    To be called last before the commit: from here on the transaction holds the outbox sequence lock.
+    """
+    rows = [{'event': event, 'announcement_id': announcement['id'],
+             'payload': json.dumps(announcement, ensure_ascii=False, default=str)}
+            for announcement in announcements]
+    if rows:
+        await db.execute(mysql_insert(models.ReferenceVersions).values(name=SEQUENCE_NAME, version=1)
+                         .on_duplicate_key_update(version=models.ReferenceVersions.version + 1))
+        await db.execute(insert(models.OutboxEvents), rows)
+
+
+def notify():
+    """
+    Wakes up the dispatcher and the feeds of this process, to be called after a commit with events
+    """
+    global _changed
+    if _changed is not None:
+        _changed.set()
+    _changed = asyncio.Event()
+
+
+async def wait(timeout: float):
+    """
+    Returns after notify() or after timeout seconds
+    """
+    global _changed
+    if _changed is None:
+        _changed = asyncio.Event()
+    try:
+        await asyncio.wait_for(_changed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+def as_dict(event: models.OutboxEvents) -> dict:
+    return {
+        'id': event.id,
+        'event': event.event,
+        'announcement_id': event.announcement_id,
+        'payload': json.loads(event.payload),
+        'created_at': event.created_at,
+    }
+
+
+async def read(db: AsyncSession, after: int, limit: int) -> List[dict]:
+    events = await db.execute(select(models.OutboxEvents)
+                              .where(models.OutboxEvents.id > after)
+                              .order_by(models.OutboxEvents.id)
+                              .limit(limit))
+    return [as_dict(event) for event in events.scalars()]
+
+
+async def get_offset(db: AsyncSession, consumer: str) -> int:
+    position = await db.execute(select(models.ConsumerOffsets.position)
+                                .where(models.ConsumerOffsets.consumer == consumer))
+    return position.scalar() or 0
+
+
+async def set_offset(db: AsyncSession, consumer: str, position: int):
+    await db.execute(mysql_insert(models.ConsumerOffsets).values(consumer=consumer, position=position)
+                     .on_duplicate_key_update(position=position))
+
+
+def external_consumer(user_id: int, name: str) -> str:
+    """
+    consumer_offsets name of the external consumer `name` of the user
+    """
+    return f'{EXTERNAL_PREFIX}{user_id}:{name}'
+
+
+def register(name: str, handler):
+    """
+    Adds an in-process consumer, `await handler(events)` is called with lists of event dicts in id order
+    """
+    if name.startswith(EXTERNAL_PREFIX):
+        raise ValueError(f'consumer names starting with {EXTERNAL_PREFIX!r} are external')
+    consumers[name] = handler
+
+
+async def dispatch(name: str, handler) -> int:
+    """
+    Hands the next batch of events to the consumer, returns the number of events delivered
+    """
+    async with database.SessionLocal() as db:
+        await db.execute(mysql_insert(models.ConsumerOffsets).prefix_with('IGNORE').values(consumer=name, position=0))
+        await db.commit()
+        position = await db.execute(select(models.ConsumerOffsets.position)
+                                    .where(models.ConsumerOffsets.consumer == name)
+                                    .with_for_update(skip_locked=True))
+        position = position.scalar()
+        if position is None:
+            # another worker is handling this consumer
+            return 0
+        events = await read(db, position, DISPATCH_BATCH_SIZE)
+        if events:
+            await handler(events)
+            await set_offset(db, name, events[-1]['id'])
+        await db.commit()
+        return len(events)
+
+
+async def prune():
+    async with database.SessionLocal() as db:
+        await db.execute(delete(models.OutboxEvents).where(
+            models.OutboxEvents.created_at < func.date_sub(func.now(),
+                                                           text(f'INTERVAL {OUTBOX_RETENTION_DAYS} DAY'))))
+        await db.commit()
+
+
+async def _run():
+    pruned_at = 0
+    while True:
+        delivered = 0
+        for name, handler in list(consumers.items()):
+            try:
+                delivered += await dispatch(name, handler)
+            except Exception:
+                logger.exception('outbox consumer %s failed', name)
+        loop_time = asyncio.get_running_loop().time()
+        if loop_time - pruned_at > PRUNE_INTERVAL:
+            pruned_at = loop_time
+            try:
+                await prune()
+            except Exception:
+                logger.exception('could not prune the outbox')
+        if not delivered:
+            await wait(DISPATCH_INTERVAL)
+
+
+async def start():
+    global _task
+    _task = asyncio.create_task(_run())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
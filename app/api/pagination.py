@@ -0,0 +1,66 @@
+import base64
+import json
+import os
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.types import DateTime
+
+DEFAULT_PAGE_SIZE = int(os.getenv('PAGE_SIZE', 20))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 100))
+
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+invalid_cursor_exception = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail='Invalid cursor',
+)
+
+
+def encode_cursor(values: Sequence) -> str:
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str, order: Sequence[Tuple]) -> List:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(order):
+            raise ValueError
+        return [datetime.fromisoformat(v) if isinstance(column.type, DateTime) else v
+                for v, (column, _) in zip(values, order)]
+    except (ValueError, TypeError):
+        raise invalid_cursor_exception
+
+
+def keyset_filter(order: Sequence[Tuple], values: Sequence):
+    """
+    Builds "rows after the cursor" condition for order = [(column, descending), ...] ending with the primary key,
+    expanded as (a > x) OR (a = x AND b > y) so MySQL can use the composite index range.
+    """
+    clauses = []
+    for i, (column, descending) in enumerate(order):
+        equal = [c == v for (c, _), v in zip(order[:i], values[:i])]
+        after = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*equal, after))
+    return or_(*clauses)
+
+
+async def paginate(db: AsyncSession, query, order: Sequence[Tuple], cursor: Optional[str], limit: int,
+                   scalars: bool = True):
+    """
+    Returns one page of the query ordered by `order` and the cursor of the next page (None for the last page).
+    scalars=False for queries of columns, the page is then a list of rows.
+    """
+    if cursor:
+        query = query.where(keyset_filter(order, decode_cursor(cursor, order)))
+    query = query.order_by(*[column.desc() if descending else column.asc() for column, descending in order])
+    result = await db.execute(query.limit(limit + 1))
+    rows = (result.scalars() if scalars else result).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor([getattr(rows[-1], column.key) for column, _ in order])
@@ -0,0 +1,178 @@
+"""
+Price statistics per town and category.
+
+price_buckets keeps, for every town, category and price bucket, how many
+announcements there are and the sum of their prices. Buckets grow
+geometrically by GROWTH, so a quantile read from them is within GROWTH of the
+exact one, and a town and category pair has a bounded number of rows however
+many announcements it has: reading its statistics does not scan announcements.
+
+Handlers that create, update or delete announcements call apply() with the
+changes in their own transaction. Whatever slips past it (rows changed outside
+the API, float rounding at bucket edges) is corrected by rebuild(), which
+recomputes the table from announcements every REBUILD_INTERVAL seconds in each
+server process, or once with `python price_stats.py`.
+"""
+import asyncio
+import itertools
+import logging
+import os
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import bindparam, case, delete, func, insert, literal_column, select, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import cache
+import database
+import models
+
+logger = logging.getLogger(__name__)
+
+# bucket b > 0 holds prices in [GROWTH ** (b - 1), GROWTH ** b), bucket 0 prices below 1;
+# changing it needs a rebuild
+GROWTH = 1.05
+# seconds between two rebuilds, 0 disables the periodic rebuild
+REBUILD_INTERVAL = float(os.getenv('PRICE_STATS_REBUILD_INTERVAL', 6 * 3600))
+REBUILD_LOCK = 'price_buckets_rebuild'
+
+# (town_id, category_id, price, +1 for an added announcement or -1 for a removed one)
+Change = Tuple[int, int, float, int]
+
+
+def bucket_of(price):
+    """
+    SQL expression of the bucket of the price, computed by the database both here and in rebuild()
+    so the two always agree
+    """
+    return case((price < 1, 0), else_=func.floor(func.ln(price) / func.ln(GROWTH)) + 1)
+
+
+async def apply(db: AsyncSession, changes: Iterable[Change]):
+    """
+    Adds the changes to the buckets in the transaction of `db`
+    """
+    rows = [{'town': town_id, 'category': category_id, 'price': price, 'delta': delta}
+            for town_id, category_id, price, delta in changes]
+    if not rows:
+        return
+    table = models.PriceBuckets.__table__
+    statement = mysql_insert(table).values(
+        town_id=bindparam('town'),
+        category_id=bindparam('category'),
+        bucket=bucket_of(bindparam('price')),
+        announcements_count=bindparam('delta'),
+        price_sum=bindparam('price') * bindparam('delta'),
+    )
+    await db.execute(statement.on_duplicate_key_update(
+        announcements_count=table.c.announcements_count + statement.inserted.announcements_count,
+        price_sum=table.c.price_sum + statement.inserted.price_sum,
+    ), rows)
+
+
+def quantile(buckets: List[Tuple[int, float]], count: int, q: float) -> float:
+    """
+    Approximate q-quantile from (count, price_sum) pairs in bucket order: the mean price of the bucket holding it
+    """
+    rank = q * (count - 1)
+    seen = 0
+    for bucket_count, price_sum in buckets:
+        seen += bucket_count
+        if seen > rank:
+            return round(price_sum / bucket_count, 2)
+    return round(buckets[-1][1] / buckets[-1][0], 2)
+
+
+async def read(db: AsyncSession, town_id: Optional[int] = None, category_id: Optional[int] = None) -> List[dict]:
+    """
+    Statistics of every town and category pair with announcements, optionally of one town and/or category
+    """
+    columns = models.PriceBuckets
+    query = (select(columns.town_id, columns.category_id, columns.announcements_count, columns.price_sum)
+             .where(columns.announcements_count > 0)
+             .order_by(columns.town_id, columns.category_id, columns.bucket))
+    if town_id is not None:
+        query = query.where(columns.town_id == town_id)
+    if category_id is not None:
+        query = query.where(columns.category_id == category_id)
+    stats = []
+    rows = await db.execute(query)
+    for (town_id, category_id), pair in itertools.groupby(rows, lambda row: (row.town_id, row.category_id)):
+        buckets = [(row.announcements_count, row.price_sum) for row in pair]
+        count = sum(bucket_count for bucket_count, _ in buckets)
+        stats.append({
+            'town_id': town_id,
+            'category_id': category_id,
+            'count': count,
+            'average_price': round(sum(price_sum for _, price_sum in buckets) / count, 2),
+            'lower_quartile': quantile(buckets, count, 0.25),
+            'median_price': quantile(buckets, count, 0.5),
+            'upper_quartile': quantile(buckets, count, 0.75),
+        })
+    return stats
+
+
+async def rebuild() -> bool:
+    """
+    Recomputes price_buckets from announcements, returns False if another process is rebuilding it
+    """
+    async with database.engine.connect() as conn:
+        locked = (await conn.execute(text('SELECT GET_LOCK(:name, 0)'), {'name': REBUILD_LOCK})).scalar()
+        # the lock is held by the session, not by the transaction the SELECT began
+        await conn.commit()
+        if not locked:
+            return False
+        try:
+            async with conn.begin():
+                announcements = models.Announcements
+                await conn.execute(delete(models.PriceBuckets))
+                await conn.execute(insert(models.PriceBuckets).from_select(
+                    ['town_id', 'category_id', 'bucket', 'announcements_count', 'price_sum'],
+                    select(announcements.town_id, announcements.category_id, bucket_of(announcements.price).label('b'),
+                           func.count(), func.sum(announcements.price))
+                    .group_by(announcements.town_id, announcements.category_id, literal_column('b'))))
+        finally:
+            await conn.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': REBUILD_LOCK})
+            await conn.commit()
+    await cache.response_cache.invalidate('announcements')
+    return True
+
+
+async def _rebuild_periodically():
+    while True:
+        await asyncio.sleep(REBUILD_INTERVAL)
+        try:
+            if await rebuild():
+                logger.info('price statistics rebuilt')
+        except SQLAlchemyError:
+            logger.exception('price statistics rebuild failed')
+
+
+_task = None
+
+
+async def start():
+    global _task
+    if REBUILD_INTERVAL > 0:
+        _task = asyncio.create_task(_rebuild_periodically())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+
+
+async def main():
+    database.connect()
+    try:
+        print('price statistics rebuilt' if await rebuild() else 'a rebuild is already running')
+    finally:
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""
+Towns and categories kept in memory.
+
+Both tables are tiny and change rarely, so every worker loads them once into an
+immutable snapshot and announcement responses take town and category names from
+it instead of joining the tables. create_town/create_category bump the version in
+reference_versions in the same transaction; each worker polls that row and
+reloads the snapshot when the version changes.
+"""
+import asyncio
+import logging
+import os
+from types import MappingProxyType
+from typing import Iterable, Mapping
+
+from sqlalchemy import select
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import budgets
+import database
+import models
+import schemas
+
+logger = logging.getLogger(__name__)
+
+REFDATA_CHECK_INTERVAL = float(os.getenv('REFDATA_CHECK_INTERVAL', 10))
+VERSION_NAME = 'reference'
+
+
+class ReferenceData:
+    def __init__(self, version: int, towns: Mapping[int, schemas.Towns_schema],
+                 categories: Mapping[int, schemas.Categories_schema]):
+        self.version = version
+        self.towns = MappingProxyType(dict(towns))
+        self.categories = MappingProxyType(dict(categories))
+
+
+current = ReferenceData(-1, {}, {})
+_lock = None
+_task = None
+
+
+async def load_version(db: AsyncSession) -> int:
+    version = await db.execute(select(models.ReferenceVersions.version)
+                               .where(models.ReferenceVersions.name == VERSION_NAME))
+    return version.scalar() or 0
+
+
+async def reload():
+    global current, _lock
+    if _lock is None:
+        _lock = asyncio.Lock()
+    async with _lock:
+        with budgets.unbudgeted():
+            async with database.SessionLocal() as db:
+                version = await load_version(db)
+                towns = (await db.execute(select(models.Towns.id, models.Towns.town_name))).all()
+                categories = (await db.execute(select(models.Categories.id, models.Categories.category_name))).all()
+        current = ReferenceData(
+            version,
+            {id: schemas.Towns_schema(town_name=town_name) for id, town_name in towns},
+            {id: schemas.Categories_schema(category_name=category_name) for id, category_name in categories},
+        )
+    return current
+
+
+async def bump_version(db: AsyncSession):
+    """
+    Marks towns/categories as changed, takes effect with the commit of `db`
+    """
+    await db.execute(insert(models.ReferenceVersions).values(name=VERSION_NAME, version=1)
+                     .on_duplicate_key_update(version=models.ReferenceVersions.version + 1))
+
+
+async def covering(town_ids: Iterable[int], category_ids: Iterable[int]) -> ReferenceData:
+    """
+    Snapshot that contains all the given ids, reloaded if some of them were created after the last load
+    """
+    snapshot = current
+    if not set(town_ids) <= snapshot.towns.keys() or not set(category_ids) <= snapshot.categories.keys():
+        snapshot = await reload()
+    return snapshot
+
+
+async def _watch():
+    while True:
+        try:
+            async with database.SessionLocal() as db:
+                version = await load_version(db)
+            if version != current.version:
+                await reload()
+        except SQLAlchemyError:
+            logger.exception('could not check reference data version')
+        await asyncio.sleep(REFDATA_CHECK_INTERVAL)
+
+
+async def start():
+    global _task
+    _task = asyncio.create_task(_watch())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
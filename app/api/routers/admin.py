@@ -1,20 +1,31 @@
-from typing import List
-from fastapi import status, Depends, HTTPException, APIRouter
+from typing import Dict, List, Optional
+from fastapi import status, Depends, HTTPException, APIRouter, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, func, select
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 
-import schemas, oath, database, models, hashing
+import schemas, oath, database, models, hashing, cache, refdata, bulk, favorites, orphans, budgets
+import pagination, serializers, outbox, price_stats, media
 
 router = APIRouter()
 
+USER_ANNOUNCEMENTS_ORDER = [(models.Announcements.created_at, True), (models.Announcements.id, True)]
+USER_FAVORITES_ORDER = [(models.Favorites.id, True)]
+ANNOUNCEMENTS_CURSOR_HEADER = 'X-Next-Announcements-Cursor'
+FAVORITES_CURSOR_HEADER = 'X-Next-Favorites-Cursor'
+
 
 @router.post('/admin/towns', status_code=status.HTTP_201_CREATED, response_model=schemas.Towns_response, tags=['Admin'])
-def create_town(request: schemas.Towns_schema, db: Session = Depends(database.get_db)):
+@budgets.query_budget(2, rows=0)
+async def create_town(request: schemas.Towns_schema, db: AsyncSession = Depends(database.get_db)):
     try:
         new_town = models.Towns(town_name=request.town_name)
         db.add(new_town)
-        db.commit()
-        db.refresh(new_town)
+        await refdata.bump_version(db)
+        await db.commit()
+        await refdata.reload()
         return new_town
     except IntegrityError:
         raise HTTPException(
@@ -22,48 +33,142 @@ def create_town(request: schemas.Towns_schema, db: Session = Depends(database.ge
             detail=f'Город {request.town_name} уже существует в БД')
 
 
-@router.get('/admin/users/{user_id}', response_model=schemas.ShowUser, status_code=status.HTTP_200_OK, tags=['Admin'])
-def show_user(user_id: int, db: Session = Depends(database.get_db)):
+@router.get('/admin/users/{user_id}', response_model=schemas.User_details, response_model_exclude_none=True,
+            status_code=status.HTTP_200_OK, tags=['Admin'])
+@budgets.query_budget(4, rows=2 + 2 * (pagination.MAX_PAGE_SIZE + 1))
+async def show_user(user_id: int, response: Response, detail: schemas.User_detail = schemas.User_detail.full,
+                    announcements_cursor: Optional[str] = None, favorites_cursor: Optional[str] = None,
+                    limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+                    db: AsyncSession = Depends(database.get_read_db)):
     """
         To view details related to a single contact
 
         - **id**: The integer id of the contact you want to view details.
+        - **detail**: summary - the contact only, counts - with the numbers of announcements and favorites,
+          full - with the counts, a page of announcements and a page of favorites.
+        - **announcements_cursor**, **favorites_cursor**: values of the X-Next-Announcements-Cursor and
+          X-Next-Favorites-Cursor headers of the previous response.
+        - **limit**: page size of both collections.
     """
-    user = db.query(models.Users).filter(models.Users.id == user_id).first()
-
+    user = await db.get(models.Users, user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f'Пользователь с ID {user_id} не найден')
-    else:
-        return user
+    ref = await refdata.covering([user.town_id], [])
+    details = serializers.user(user, ref)
+    if detail == schemas.User_detail.summary:
+        return details
+
+    counts = await db.execute(select(
+        select(func.count()).where(models.Announcements.user_id == user_id).scalar_subquery(),
+        select(func.count()).where(models.Favorites.user_id == user_id).scalar_subquery(),
+    ))
+    details['announcements_count'], details['favorites_count'] = counts.one()
+    if detail == schemas.User_detail.counts:
+        return details
+
+    announcements, next_cursor = await pagination.paginate(
+        db, select(models.Announcements).where(models.Announcements.user_id == user_id),
+        USER_ANNOUNCEMENTS_ORDER, announcements_cursor, limit)
+    if next_cursor:
+        response.headers[ANNOUNCEMENTS_CURSOR_HEADER] = next_cursor
+    favorites, next_cursor = await pagination.paginate(
+        db, select(models.Favorites).where(models.Favorites.user_id == user_id)
+        .options(joinedload(models.Favorites.announcement)),
+        USER_FAVORITES_ORDER, favorites_cursor, limit)
+    if next_cursor:
+        response.headers[FAVORITES_CURSOR_HEADER] = next_cursor
+    details['announcement'] = announcements
+    # every favorite embeds the same user, serialized once
+    short_user = serializers.user(user, ref)
+    details['favorite'] = [{
+        'id': favorite.id,
+        'user_id': favorite.user_id,
+        'announcement_id': favorite.announcement_id,
+        'announcement': favorite.announcement,
+        'user': short_user,
+    } for favorite in favorites]
+    return details
 
 
 @router.delete('/admin/users/{user_id}', status_code=status.HTTP_200_OK, tags=['Admin'])
-def delete_user(user_id: int, db: Session = Depends(database.get_db)):
+@budgets.query_budget(10)
+async def delete_user(user_id: int, db: AsyncSession = Depends(database.get_db)):
     """
         To remove a single contact
 
         - **id**: The integer id of the contact you want to remove.
     """
-    removable_user = db.query(models.Users).filter(models.Users.id == user_id).first()
-    if not removable_user:
+    favorite_ids = await favorites.announcement_ids(db, user_id)
+    files = await orphans.announcement_files(db, models.Announcements.user_id == user_id)
+    image_ids = await orphans.image_ids(db, models.Announcements.user_id == user_id)
+    announcements = await db.execute(
+        select(models.Announcements.id, models.Announcements.town_id, models.Announcements.category_id,
+               models.Announcements.price)
+        .where(models.Announcements.user_id == user_id))
+    announcements = announcements.all()
+    result = await db.execute(delete(models.Users).where(models.Users.id == user_id))
+    if not result.rowcount:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f'user {user_id} not found')
-    else:
-        db.query(models.Users).filter(models.Users.id == user_id).delete(synchronize_session=False)
-    db.commit()
+    # favorites and announcements of the user are deleted by the foreign key cascade
+    await favorites.refresh_counts(db, favorite_ids)
+    await price_stats.apply(db, [(announcement.town_id, announcement.category_id, announcement.price, -1)
+                                 for announcement in announcements])
+    await outbox.record(db, outbox.DELETED, [{'id': announcement.id, 'user_id': user_id}
+                                             for announcement in announcements])
+    await db.commit()
+    oath.token_versions.delete(user_id)
+    await cache.response_cache.invalidate('announcements')
+    await favorites.publish_counts(db, favorite_ids)
+    media.forget_images(image_ids)
+    outbox.notify()
+    orphans.enqueue(files)
     return {'detail': f'пользователь с ID {user_id} удален'}
 
 
+@router.post('/admin/announcements/import', status_code=status.HTTP_200_OK, response_model=schemas.Import_report,
+             tags=['Admin'])
+@budgets.query_budget(None)
+async def import_announcements(request: Request, format: schemas.Bulk_format = schemas.Bulk_format.ndjson,
+                               db: AsyncSession = Depends(database.get_db)):
+    """
+        Bulk creation of announcements, the request body is read as a stream
+
+        - **format**: ndjson - one Announcement_import_schema object per line,
+          csv - header row with price, category_id, text, town_id, user_id then one announcement per row.
+        Valid rows are inserted in batches, the report lists the rejected ones by their number.
+    """
+    return await bulk.import_announcements(db, request.stream(), format)
+
+
+@router.get('/admin/announcements/export', status_code=status.HTTP_200_OK, tags=['Admin'])
+@budgets.query_budget(1)
+async def export_announcements(format: schemas.Bulk_format = schemas.Bulk_format.ndjson, after_id: int = 0,
+                               db: AsyncSession = Depends(database.get_read_db)):
+    """
+        All announcements in id order, streamed in the format import accepts
+
+        - **after_id**: resume an interrupted export after the last received id.
+    """
+    # the session stays open until the response is sent, dependencies are closed after it
+    media_type = 'text/csv' if format == schemas.Bulk_format.csv else 'application/x-ndjson'
+    return StreamingResponse(bulk.export_announcements(db, format, after_id), media_type=media_type,
+                             headers={'Content-Disposition': f'attachment; filename=announcements.{format.value}'})
+
+
 @router.post('/admin/filters', status_code=status.HTTP_201_CREATED, response_model=schemas.Show_Categories, tags=['Admin'])
-def create_category(request: schemas.Categories_schema, db: Session = Depends(database.get_db)):
+@budgets.query_budget(2, rows=0)
+async def create_category(request: schemas.Categories_schema, db: AsyncSession = Depends(database.get_db)):
     try:
         new_category = models.Categories(category_name=request.category_name)
         db.add(new_category)
-        db.commit()
-        db.refresh(new_category)
+        await refdata.bump_version(db)
+        await db.commit()
+        await refdata.reload()
+        await cache.response_cache.invalidate('categories')
         return new_category
     except IntegrityError:
         raise HTTPException(
@@ -72,10 +177,34 @@ def create_category(request: schemas.Categories_schema, db: Session = Depends(da
 
 
 @router.get('/admin/filters', status_code=status.HTTP_200_OK, response_model=List[schemas.Show_Categories], tags=['Admin'])
-def show_all_categories(db: Session = Depends(database.get_db)):
-    return db.query(models.Categories).all()
+@budgets.query_budget(1)
+async def show_all_categories(request: Request, response: Response, db: AsyncSession = Depends(database.get_read_db)):
+    async def produce():
+        return (await db.execute(select(models.Categories))).scalars().all()
+
+    return await cache.response_cache.respond(request, response, 'categories', List[schemas.Show_Categories], produce)
 
 
 @router.get('/admin/filters/{filter_id}', status_code=status.HTTP_200_OK, response_model=schemas.Show_Categories, tags=['Admin'])
-def show_category(filter_id: int, db: Session = Depends(database.get_db)):
-    return db.query(models.Categories).filter(models.Categories.id == filter_id).first()
\ No newline at end of file
+@budgets.query_budget(1, rows=1)
+async def show_category(filter_id: int, request: Request, response: Response,
+                        db: AsyncSession = Depends(database.get_read_db)):
+    async def produce():
+        category = await db.get(models.Categories, filter_id)
+        if not category:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f'Категория с ID {filter_id} не найдена')
+        return category
+
+    return await cache.response_cache.respond(request, response, 'categories', schemas.Show_Categories, produce)
+
+
+@router.get('/admin/pool', status_code=status.HTTP_200_OK, response_model=Dict[str, schemas.Pool_status], tags=['Admin'])
+@budgets.query_budget(0)
+async def show_pool_status():
+    """
+        Connection pool usage per engine: connections checked out, overflow in use,
+        time spent waiting for a free connection, checkout timeouts and invalidated connections.
+    """
+    return database.pool_status()
@@ -0,0 +1,90 @@
+import asyncio
+import json
+from typing import List, Optional
+from fastapi import status, Depends, APIRouter, Header, Path, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import schemas, oath, database, models, outbox, budgets
+
+router = APIRouter()
+
+MAX_WAIT = 30
+FEED_BATCH_SIZE = 500
+# seconds between two checks for events of other workers, and between SSE keep-alive comments
+FEED_POLL_INTERVAL = 1
+KEEP_ALIVE_INTERVAL = 15
+
+
+@router.get('/events', response_model=List[schemas.Change_event], status_code=status.HTTP_200_OK, tags=['Events'])
+@budgets.query_budget(None, rows=FEED_BATCH_SIZE + 1)
+async def read_events(after: Optional[int] = None,
+                      consumer: Optional[str] = Query(None, max_length=outbox.EXTERNAL_NAME_LENGTH),
+                      limit: int = Query(100, ge=1, le=FEED_BATCH_SIZE), wait: int = Query(0, ge=0, le=MAX_WAIT),
+                      current_user: models.Users = Depends(oath.get_current_user_id)):
+    """
+        Announcement changes in the order they were committed (long-poll)
+
+        - **after**: id of the last event received; the stored offset of **consumer** if not given.
+          Consumer names are per user, two users' consumers of the same name are distinct.
+        - **wait**: seconds to wait for new events when there are none yet.
+        Acknowledge processed events with PUT /events/offsets/{consumer} to resume from there later.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    while True:
+        async with database.SessionLocal() as db:
+            if after is None:
+                after = await outbox.get_offset(db, outbox.external_consumer(current_user, consumer)) if consumer else 0
+            events = await outbox.read(db, after, limit)
+        remaining = deadline - loop.time()
+        if events or remaining <= 0:
+            return events
+        await outbox.wait(min(remaining, FEED_POLL_INTERVAL))
+
+
+@router.get('/events/stream', status_code=status.HTTP_200_OK, tags=['Events'])
+@budgets.query_budget(None)
+async def stream_events(request: Request, after: Optional[int] = None,
+                        last_event_id: Optional[int] = Header(None),
+                        current_user: models.Users = Depends(oath.get_current_user_id)):
+    """
+        Announcement changes as server-sent events, each with the event id as its SSE id.
+        Reconnecting clients resume after the Last-Event-ID header, or after **after**.
+    """
+    async def stream():
+        position = last_event_id if last_event_id is not None else after or 0
+        idle = 0
+        while not await request.is_disconnected():
+            async with database.SessionLocal() as db:
+                events = await outbox.read(db, position, FEED_BATCH_SIZE)
+            for event in events:
+                data = json.dumps(jsonable_encoder(event), ensure_ascii=False)
+                yield f'id: {event["id"]}\nevent: {event["event"]}\ndata: {data}\n\n'
+                position = event['id']
+            if events:
+                idle = 0
+                continue
+            idle += FEED_POLL_INTERVAL
+            if idle >= KEEP_ALIVE_INTERVAL:
+                idle = 0
+                yield ': keep-alive\n\n'
+            await outbox.wait(FEED_POLL_INTERVAL)
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@router.put('/events/offsets/{consumer}', status_code=status.HTTP_200_OK, tags=['Events'])
+@budgets.query_budget(1, rows=0)
+async def save_offset(request: schemas.Consumer_offset,
+                      consumer: str = Path(..., max_length=outbox.EXTERNAL_NAME_LENGTH),
+                      db: AsyncSession = Depends(database.get_db),
+                      current_user: models.Users = Depends(oath.get_current_user_id)):
+    """
+        Stores the position of the current user's **consumer**, the offsets of other users
+        and of the server's own consumers can't be reached from here
+    """
+    await outbox.set_offset(db, outbox.external_consumer(current_user, consumer), request.position)
+    await db.commit()
+    return {'detail': f'offset of {consumer} is {request.position}'}
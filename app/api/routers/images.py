@@ -0,0 +1,45 @@
+import os
+from fastapi import status, Depends, APIRouter, HTTPException, Path, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+import schemas, database, models, media, budgets
+
+router = APIRouter()
+
+
+async def serve(request: Request, key, image_size: schemas.Image_size, load, ttl: float = media.IMAGE_CACHE_TTL):
+    info = await media.find(key, image_size, load, ttl)
+    if info is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Изображение не найдено')
+    path, etag, final = info
+    try:
+        stat_result = await run_in_threadpool(os.stat, path)
+    except FileNotFoundError:
+        media.forget(key, image_size)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Изображение не найдено')
+    return media.respond(request, path, etag, final, stat_result)
+
+
+@router.get('/images/{image_id}', status_code=status.HTTP_200_OK, tags=['Images'])
+@budgets.query_budget(1, rows=1)
+async def show_image(image_id: int, request: Request, size: schemas.Image_size = schemas.Image_size.original,
+                     db: AsyncSession = Depends(database.get_db)):
+    """
+        The image file, resized to **size** once it is rendered.
+        Supports conditional requests (ETag, Last-Modified) and a single byte range.
+    """
+    return await serve(request, image_id, size,
+                       lambda: media.lookup(db, models.Images.id == image_id, size), media.IMAGE_ID_CACHE_TTL)
+
+
+@router.get('/images/hash/{content_hash}', status_code=status.HTTP_200_OK, tags=['Images'])
+@budgets.query_budget(1, rows=1)
+async def show_image_by_hash(request: Request, content_hash: str = Path(..., regex='^[0-9a-f]{64}$'),
+                             size: schemas.Image_size = schemas.Image_size.original,
+                             db: AsyncSession = Depends(database.get_db)):
+    """
+        The image file with the given sha256 of its content
+    """
+    return await serve(request, content_hash, size,
+                       lambda: media.lookup(db, models.Images.content_hash == content_hash, size))
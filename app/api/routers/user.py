@@ -1,32 +1,125 @@
-from pathlib import Path
+from datetime import datetime
 from typing import List
-from os import remove
-from aiofiles import open
-from fastapi import status, Depends, HTTPException, File, UploadFile, Form, APIRouter
+from typing import Optional
+from fastapi import status, Depends, HTTPException, File, UploadFile, Form, APIRouter, Query, Request, Response
+from sqlalchemy import delete, func, insert, select, update
 from sqlalchemy.exc import IntegrityError, DataError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
 
-import schemas, oath, database, models, hashing
+import schemas, oath, database, models, hashing, pagination, fulltext, storage, thumbnails, cache, favorites
+import serializers, orphans, budgets, outbox, price_stats, refdata, admission, media
 
 router = APIRouter()
 
+ANNOUNCEMENTS_ORDERS = {
+    schemas.Announcement_sort.newest: [(models.Announcements.created_at, True), (models.Announcements.id, True)],
+    schemas.Announcement_sort.oldest: [(models.Announcements.created_at, False), (models.Announcements.id, False)],
+    schemas.Announcement_sort.price_asc: [(models.Announcements.price, False), (models.Announcements.id, False)],
+    schemas.Announcement_sort.price_desc: [(models.Announcements.price, True), (models.Announcements.id, True)],
+}
 
-@router.post('/auth', status_code=status.HTTP_201_CREATED, response_model=schemas.ShowUser, tags=['Users'])
-def create_user(request: schemas.ShowUser, db: Session = Depends(database.get_db)):
+# query budgets: an announcement in a response costs its row, its user's row and up to
+# IMAGES_PER_ANNOUNCEMENT image rows with the row of the requested derivative each
+IMAGES_PER_ANNOUNCEMENT = 10
+ANNOUNCEMENT_ROWS = 2 + IMAGES_PER_ANNOUNCEMENT * 2
+PAGE_ROWS = (pagination.MAX_PAGE_SIZE + 1) * ANNOUNCEMENT_ROWS
+
+
+def announcements_query(image_size: schemas.Image_size = schemas.Image_size.original):
+    """
+    Announcements with everything serializers.announcement needs: users and images are fetched by one IN-query
+    each, towns and categories come from refdata, so a page costs three bounded queries (four with resized images).
+    """
+    images = selectinload(models.Announcements.image)
+    if image_size != schemas.Image_size.original:
+        images = images.selectinload(models.Images.derivative)
+    return select(models.Announcements).options(
+        selectinload(models.Announcements.user),
+        images,
+    )
+
+
+async def announcements_page(db: AsyncSession, query, response: Response, cursor: Optional[str], limit: int,
+                             sort: schemas.Announcement_sort = schemas.Announcement_sort.newest, scalars: bool = True):
+    announcements, next_cursor = await pagination.paginate(db, query, ANNOUNCEMENTS_ORDERS[sort], cursor, limit,
+                                                           scalars)
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+    return announcements
+
+
+async def announcements_listing(db: AsyncSession, response: Response, conditions, cursor: Optional[str], limit: int,
+                                image_size: schemas.Image_size, fast: bool,
+                                sort: schemas.Announcement_sort = schemas.Announcement_sort.newest):
+    """
+    Page of announcements matching the conditions and their ids: list of serialized announcements,
+    built from column tuples in fast mode. Empty list for an empty page.
+    """
+    if fast:
+        query = select(*serializers.ANNOUNCEMENT_COLUMNS).where(*conditions)
+        rows = await announcements_page(db, query, response, cursor, limit, sort, scalars=False)
+        return rows and await serializers.fast_announcements(db, rows, image_size), [row.id for row in rows]
+    query = announcements_query(image_size).where(*conditions)
+    rows = await announcements_page(db, query, response, cursor, limit, sort)
+    return rows and await serializers.announcements(rows, image_size), [row.id for row in rows]
+
+
+async def with_favorites_counts(content, announcement_ids: List[int]) -> bytes:
+    """
+    Body of cached announcement content with the favorites counts published since it was cached
+    """
+    return serializers.encode(await favorites.merge_counts(content, announcement_ids))
+
+
+def announcement_filters(town_id: Optional[int] = None, category_id: Optional[int] = None,
+                         user_id: Optional[int] = None, price_min: Optional[float] = None,
+                         price_max: Optional[float] = None, created_since: Optional[datetime] = None):
+    """
+    Query parameters of the announcements listing as SQL conditions keyed by parameter name
+    """
+    conditions = {}
+    if town_id is not None:
+        conditions['town_id'] = models.Announcements.town_id == town_id
+    if category_id is not None:
+        conditions['category_id'] = models.Announcements.category_id == category_id
+    if user_id is not None:
+        conditions['user_id'] = models.Announcements.user_id == user_id
+    if price_min is not None:
+        conditions['price_min'] = models.Announcements.price >= price_min
+    if price_max is not None:
+        conditions['price_max'] = models.Announcements.price <= price_max
+    if created_since is not None:
+        conditions['created_since'] = models.Announcements.created_at >= created_since
+    return conditions
+
+
+@router.post('/auth', status_code=status.HTTP_201_CREATED, response_model=schemas.ShowUser, tags=['Users'],
+             dependencies=[Depends(admission.admit_client)])
+@budgets.query_budget(2, rows=1)
+@admission.cost(10)
+async def create_user(request: schemas.User_schema, db: AsyncSession = Depends(database.get_db)):
     """
         - **email** is unique.
         - **mobile_phone** is unique.
     """
+    town = await db.get(models.Towns, request.town_id)
+    if not town:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail='Введенные данные некоректны',
+        )
     try:
         new_user = models.Users(first_name=request.first_name,
                                 last_name=request.last_name,
                                 email=request.email,
                                 mobile_phone=request.mobile_phone,
-                                town_id=request.town_id,
-                                password_hash=hashing.Hash.bcrypt(request.password_hash))
+                                town=town,
+                                password_hash=await hashing.hash_password(request.password_hash),
+                                announcement=[],
+                                favorite=[])
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
         return new_user
     except IntegrityError:
         raise HTTPException(
@@ -41,14 +134,19 @@ def create_user(request: schemas.ShowUser, db: Session = Depends(database.get_db
 
 
 @router.post('/create_announcement', response_model=schemas.Announcement_schema_response, tags=['Users'])
+@budgets.query_budget(8, rows=ANNOUNCEMENT_ROWS)
+@admission.cost(5)
 async def create_announcement(price: float = Form(...), category_id: int = Form(...), text: str = Form(...),
-                              town_id: int = Form(...), files: List[UploadFile] = File(...),
-                              db: Session = Depends(database.get_db),
+                              town_id: int = Form(...),
+                              files: List[UploadFile] = File(..., max_items=IMAGES_PER_ANNOUNCEMENT),
+                              db: AsyncSession = Depends(database.get_db),
                               current_user_id: models.Users = Depends(oath.get_current_user_id)):
     """
         - **email** is unique.
         - **mobile_phone** is unique.
+        - **files**: up to 10 images.
     """
+    stored_files = [await storage.save_upload(file) for file in files]
     try:
         new_announcement = models.Announcements(
             user_id=current_user_id,
@@ -58,158 +156,349 @@ async def create_announcement(price: float = Form(...), category_id: int = Form(
             town_id=town_id
         )
         db.add(new_announcement)
-        db.commit()
-        db.refresh(new_announcement)
+        await db.flush()
+        await db.execute(insert(models.Images), [
+            {'announcement_id': new_announcement.id, 'data_path': str(path), 'content_hash': content_hash}
+            for content_hash, path in stored_files
+        ])
+        await price_stats.apply(db, [(town_id, category_id, price, 1)])
+        await outbox.record(db, outbox.CREATED, [{
+            'id': new_announcement.id,
+            'user_id': current_user_id,
+            'price': price,
+            'category_id': category_id,
+            'text': text,
+            'town_id': town_id,
+        }])
+        await db.commit()
     except IntegrityError:
-        return HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                             detail='category_id or town_id doesnt exist')
-
-    for file in files:
-        parts = ["data", file.filename]
-        file_path = Path.cwd().joinpath(*parts)
-
-        async with open(file_path, 'wb') as out_file:
-            content = await file.read()
-            await out_file.write(content)
-        new_image = models.Images(
-            announcement_id=new_announcement.id,
-            data_path=str(file_path)
-        )
-        db.add(new_image)
-        db.commit()
-        db.refresh(new_image)
-    return new_announcement
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail='category_id or town_id doesnt exist')
+    query = announcements_query().where(models.Announcements.id == new_announcement.id)
+    new_announcement = (await db.execute(query.execution_options(populate_existing=True))).scalars().first()
+    await cache.response_cache.invalidate('announcements')
+    outbox.notify()
+    thumbnails.enqueue(image.id for image in new_announcement.image)
+    return (await serializers.announcements([new_announcement]))[0]
 
 
 @router.put('/announcements/{announcement_id}', status_code=status.HTTP_202_ACCEPTED, tags=['Users'])
-def update_announcement(announcement_id: int, request: schemas.Announcement_schema, db: Session = Depends(database.get_db),
-                        current_user: models.Users = Depends(oath.get_current_user_id)):
-    if not db.query(models.Announcements).filter(models.Announcements.id == announcement_id).first():
+@budgets.query_budget(5, rows=1)
+async def update_announcement(announcement_id: int, request: schemas.Announcement_schema,
+                              db: AsyncSession = Depends(database.get_db),
+                              current_user: models.Users = Depends(oath.get_current_user_id)):
+    previous = await db.execute(
+        select(models.Announcements.town_id, models.Announcements.category_id, models.Announcements.price)
+        .where(models.Announcements.id == announcement_id)
+        .with_for_update())
+    previous = previous.first()
+    if previous is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'Announcement with id {announcement_id} not found')
-    db.query(models.Announcements).filter(models.Announcements.id == announcement_id).update({
-        'price': request.price,
-        'category_id': request.category_id,
-        'text': request.text,
-        'town_id': request.town_id
-    }, synchronize_session='evaluate')
-    db.commit()
+    await db.execute(update(models.Announcements).where(models.Announcements.id == announcement_id).values(
+        price=request.price,
+        category_id=request.category_id,
+        text=request.text,
+        town_id=request.town_id,
+    ))
+    await price_stats.apply(db, [(*previous, -1), (request.town_id, request.category_id, request.price, 1)])
+    await outbox.record(db, outbox.UPDATED, [{'id': announcement_id, **request.dict()}])
+    await db.commit()
+    await cache.response_cache.invalidate('announcements')
+    outbox.notify()
     return {'data': f'Announcement with id {announcement_id} successfully updated'}
 
 
 @router.get('/announcements', response_model=List[schemas.Announcement_schema_response], status_code=status.HTTP_200_OK,
             tags=['Users'])
-def show_all_announcements(db: Session = Depends(database.get_db),
-                        current_user: models.Users = Depends(oath.get_current_user_id)):
-    return db.query(models.Announcements).all()
+@budgets.query_budget(4, rows=PAGE_ROWS)
+@admission.cost(3, expensive=True)
+async def show_all_announcements(request: Request, response: Response, cursor: Optional[str] = None,
+                                 limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+                                 sort: schemas.Announcement_sort = schemas.Announcement_sort.newest,
+                                 filters: dict = Depends(announcement_filters),
+                                 image_size: schemas.Image_size = schemas.Image_size.original,
+                                 fast: bool = False,
+                                 db: AsyncSession = Depends(database.get_read_db),
+                                 current_user: models.Users = Depends(oath.get_current_user_id)):
+    """
+        - **town_id**, **category_id**, **user_id**, **price_min**, **price_max**, **created_since**:
+          optional filters, any combination.
+        - **sort**: newest, oldest, price_asc or price_desc.
+        - **cursor**: value of the X-Next-Cursor header of the previous page.
+        - **limit**: page size.
+        - **image_size**: original or one of the resized versions of the images.
+        - **fast**: build the page from column tuples and encode it with orjson, same output.
+    """
+    async def produce():
+        return await announcements_listing(db, response, filters.values(), cursor, limit, image_size, fast, sort)
+
+    return await cache.response_cache.respond(request, response, 'announcements',
+                                              List[schemas.Announcement_schema_response], produce,
+                                              with_favorites_counts)
+
+
+@router.get('/announcements/facets', response_model=schemas.Announcement_facets, status_code=status.HTTP_200_OK,
+            tags=['Users'])
+@budgets.query_budget(2)
+@admission.cost(3, expensive=True)
+async def show_announcement_facets(filters: dict = Depends(announcement_filters),
+                                   db: AsyncSession = Depends(database.get_read_db),
+                                   current_user: models.Users = Depends(oath.get_current_user_id)):
+    """
+        Number of announcements per town and per category for the same filters as GET /announcements.
+        Town counts ignore the town_id filter and category counts ignore the category_id filter.
+    """
+    facets = {}
+    for facet, column in (('towns', models.Announcements.town_id), ('categories', models.Announcements.category_id)):
+        conditions = [condition for name, condition in filters.items() if name != column.key]
+        rows = await db.execute(select(column, func.count()).where(*conditions).group_by(column))
+        facets[facet] = [{'id': id, 'count': count} for id, count in rows]
+    return facets
+
+
+@router.get('/announcements/prices', response_model=List[schemas.Price_stats], status_code=status.HTTP_200_OK,
+            tags=['Users'])
+@budgets.query_budget(1)
+async def show_price_stats(request: Request, response: Response, town_id: Optional[int] = None,
+                           category_id: Optional[int] = None, db: AsyncSession = Depends(database.get_read_db),
+                           current_user: models.Users = Depends(oath.get_current_user_id)):
+    """
+        Number of announcements, average price and approximate quartiles of the price (within 5%)
+        per town and category, optionally of one **town_id** and/or **category_id**.
+        Read from maintained price buckets, announcements are not scanned.
+    """
+    async def produce():
+        stats = await price_stats.read(db, town_id, category_id)
+        ref = await refdata.covering([stat['town_id'] for stat in stats], [stat['category_id'] for stat in stats])
+        return [{**stat, 'town': ref.towns[stat['town_id']], 'category': ref.categories[stat['category_id']]}
+                for stat in stats]
+
+    return await cache.response_cache.respond(request, response, 'announcements', List[schemas.Price_stats], produce)
 
 
 @router.get('/announcements/{announcement_id}', response_model=schemas.Announcement_schema_response,
             status_code=status.HTTP_200_OK,
             tags=['Users'])
-def show_announcement(announcement_id: int, db: Session = Depends(database.get_db),
-                        current_user: models.Users = Depends(oath.get_current_user_id)):
-    announcement = db.query(models.Announcements).filter(models.Announcements.id == announcement_id).first()
-    if not announcement:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'announcement with id {announcement_id} not found')
-    return announcement
+@budgets.query_budget(4, rows=ANNOUNCEMENT_ROWS)
+async def show_announcement(announcement_id: int, request: Request, response: Response,
+                            image_size: schemas.Image_size = schemas.Image_size.original,
+                            db: AsyncSession = Depends(database.get_read_db),
+                            current_user: models.Users = Depends(oath.get_current_user_id)):
+    async def produce():
+        query = announcements_query(image_size).where(models.Announcements.id == announcement_id)
+        announcement = (await db.execute(query)).scalars().first()
+        if not announcement:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f'announcement with id {announcement_id} not found')
+        return (await serializers.announcements([announcement], image_size))[0], [announcement.id]
+
+    return await cache.response_cache.respond(request, response, 'announcements',
+                                              schemas.Announcement_schema_response, produce,
+                                              with_favorites_counts)
 
 
 @router.get('/announcements/user/{user_id}', response_model=List[schemas.Announcement_schema_response],
             status_code=status.HTTP_200_OK,
             tags=['Users'])
-def show_announcements_of_the_user(user_id: int, db: Session = Depends(database.get_db),
-                        current_user: models.Users = Depends(oath.get_current_user_id)):
-    announcement = db.query(models.Announcements).filter(models.Announcements.user_id == user_id).all()
-    if not announcement:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'user with id {user_id} not found')
-    return announcement
+@budgets.query_budget(4, rows=PAGE_ROWS)
+@admission.cost(3, expensive=True)
+async def show_announcements_of_the_user(user_id: int, request: Request, response: Response,
+                                         cursor: Optional[str] = None,
+                                         limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1,
+                                                            le=pagination.MAX_PAGE_SIZE),
+                                         image_size: schemas.Image_size = schemas.Image_size.original,
+                                         fast: bool = False,
+                                         db: AsyncSession = Depends(database.get_read_db),
+                                         current_user: models.Users = Depends(oath.get_current_user_id)):
+    async def produce():
+        conditions = [models.Announcements.user_id == user_id]
+        announcement, ids = await announcements_listing(db, response, conditions, cursor, limit, image_size, fast)
+        if not ids and not cursor:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f'user with id {user_id} not found')
+        return announcement, ids
+
+    return await cache.response_cache.respond(request, response, 'announcements',
+                                              List[schemas.Announcement_schema_response], produce,
+                                              with_favorites_counts)
 
 
 @router.get('/announcements/town/{town_id}',
             status_code=status.HTTP_200_OK, response_model=List[schemas.Announcement_schema_response], tags=['Users'])
-def show_announcements_towns_filtered(town_id: int, db: Session = Depends(database.get_db),
-                        current_user: models.Users = Depends(oath.get_current_user_id)):
-    town = db.query(models.Announcements).filter(models.Announcements.town_id == town_id).all()
+@budgets.query_budget(4, rows=PAGE_ROWS)
+@admission.cost(3, expensive=True)
+async def show_announcements_towns_filtered(town_id: int, request: Request, response: Response,
+                                            cursor: Optional[str] = None,
+                                            limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1,
+                                                               le=pagination.MAX_PAGE_SIZE),
+                                            image_size: schemas.Image_size = schemas.Image_size.original,
+                                            fast: bool = False,
+                                            db: AsyncSession = Depends(database.get_read_db),
+                                            current_user: models.Users = Depends(oath.get_current_user_id)):
+    async def produce():
+        conditions = [models.Announcements.town_id == town_id]
+        town, ids = await announcements_listing(db, response, conditions, cursor, limit, image_size, fast)
+        if not ids and not cursor:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f'Town with id {town_id} not found')
+        return town, ids
 
-    if not town:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'Town with id {town_id} not found')
-    return town
+    return await cache.response_cache.respond(request, response, 'announcements',
+                                              List[schemas.Announcement_schema_response], produce,
+                                              with_favorites_counts)
 
 
 @router.get('/announcements/category/{category_id}', response_model=List[schemas.Announcement_schema_response],
             status_code=status.HTTP_200_OK,
             tags=['Users'])
-def show_announcements_category_filtered(category_id: int, db: Session = Depends(database.get_db),
-                        current_user: models.Users = Depends(oath.get_current_user_id)):
-    category = db.query(models.Announcements).filter(models.Announcements.category_id == category_id).all()
-    if not category:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'Сategory with id {category_id} not found')
-    return category
+@budgets.query_budget(4, rows=PAGE_ROWS)
+@admission.cost(3, expensive=True)
+async def show_announcements_category_filtered(category_id: int, request: Request, response: Response,
+                                               cursor: Optional[str] = None,
+                                               limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1,
+                                                                  le=pagination.MAX_PAGE_SIZE),
+                                               image_size: schemas.Image_size = schemas.Image_size.original,
+                                               fast: bool = False,
+                                               db: AsyncSession = Depends(database.get_read_db),
+                                               current_user: models.Users = Depends(oath.get_current_user_id)):
+    async def produce():
+        conditions = [models.Announcements.category_id == category_id]
+        category, ids = await announcements_listing(db, response, conditions, cursor, limit, image_size, fast)
+        if not ids and not cursor:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f'Сategory with id {category_id} not found')
+        return category, ids
+
+    return await cache.response_cache.respond(request, response, 'announcements',
+                                              List[schemas.Announcement_schema_response], produce,
+                                              with_favorites_counts)
 
 
 @router.post('/user/{current_user_id}/favorite/{announcement_id}', status_code=status.HTTP_200_OK,
              tags=['Users'])
-def add_favorite(announcement_id: int, db: Session = Depends(database.get_db),
-                 current_user_id: models.Users = Depends(oath.get_current_user_id)):
-    favorite = models.Favorites(
-        user_id=current_user_id,
-        announcement_id=announcement_id,
-    )
-    db.add(favorite)
-    db.commit()
-    db.refresh(favorite)
+@budgets.query_budget(3, rows=1)
+async def add_favorite(announcement_id: int, db: AsyncSession = Depends(database.get_db),
+                       current_user_id: models.Users = Depends(oath.get_current_user_id)):
+    await favorites.add(db, current_user_id, [announcement_id])
+    await db.commit()
+    await favorites.publish_counts(db, [announcement_id])
     return {'detail': f'обьявление с ID {announcement_id} добавлено в избранные'}
 
 
+@router.post('/user/{current_user_id}/favorite/', response_model=schemas.Favorites_changed,
+             status_code=status.HTTP_200_OK, tags=['Users'])
+@budgets.query_budget(3, rows=1000)
+async def add_favorites(request: schemas.Favorite_ids, db: AsyncSession = Depends(database.get_db),
+                        current_user_id: models.Users = Depends(oath.get_current_user_id)):
+    """
+        Adds several announcements to the favorites in one statement
+
+        - **announcement_ids**: up to 1000 ids, unknown ids and current favorites are skipped.
+    """
+    changed = await favorites.add(db, current_user_id, request.announcement_ids)
+    await db.commit()
+    await favorites.publish_counts(db, request.announcement_ids)
+    return {'changed': changed}
+
+
 @router.get('/user/{current_user_id}/favorite/', response_model=List[schemas.ShowFav], status_code=status.HTTP_200_OK,
             tags=['Users'])
-def get_favorites(db: Session = Depends(database.get_db), current_user_id: models.Users = Depends(oath.get_current_user_id)):
-    return db.query(models.Favorites).filter(models.Favorites.user_id == current_user_id).all()
+@budgets.query_budget(1)
+async def get_favorites(db: AsyncSession = Depends(database.get_read_db),
+                        current_user_id: models.Users = Depends(oath.get_current_user_id)):
+    query = select(models.Favorites).where(models.Favorites.user_id == current_user_id).options(
+        joinedload(models.Favorites.announcement),
+        joinedload(models.Favorites.user).joinedload(models.Users.town),
+    )
+    return (await db.execute(query)).scalars().all()
+
+
+@router.get('/user/{current_user_id}/favorite/ids', response_model=List[int], status_code=status.HTTP_200_OK,
+            tags=['Users'])
+@budgets.query_budget(1)
+async def get_favorite_ids(db: AsyncSession = Depends(database.get_read_db),
+                           current_user_id: models.Users = Depends(oath.get_current_user_id)):
+    """
+        Ids of the favorite announcements only, in the order they were added
+    """
+    return await favorites.announcement_ids(db, current_user_id)
+
+
+@router.delete('/user/{current_user_id}/favorite/', response_model=schemas.Favorites_changed,
+               status_code=status.HTTP_200_OK, tags=['Users'])
+@budgets.query_budget(3, rows=1000)
+async def delete_from_favorites(announcement_id: List[int] = Query(..., max_items=1000),
+                                db: AsyncSession = Depends(database.get_db),
+                                current_user_id: models.Users = Depends(oath.get_current_user_id)):
+    """
+        Removes several announcements from the favorites in one statement
+
+        - **announcement_id**: repeated query parameter, up to 1000 ids.
+    """
+    changed = await favorites.remove(db, current_user_id, announcement_id)
+    await db.commit()
+    await favorites.publish_counts(db, announcement_id)
+    return {'changed': changed}
 
 
 @router.delete('/user/{current_user_id}/favorite/{announcement_id}', status_code=status.HTTP_200_OK, tags=['Users'])
-def delete_from_favorite(announcement_id: int, db: Session = Depends(database.get_db),
-                         current_user_id: models.Users = Depends(oath.get_current_user_id)):
-    removable_announcement = db.query(models.Favorites).filter(models.Favorites.announcement_id == announcement_id)
-    if not removable_announcement.first():
+@budgets.query_budget(3, rows=1)
+async def delete_from_favorite(announcement_id: int, db: AsyncSession = Depends(database.get_db),
+                               current_user_id: models.Users = Depends(oath.get_current_user_id)):
+    if not await favorites.remove(db, current_user_id, [announcement_id]):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f'Announcement with id {announcement_id} not found')
-    removable_announcement.delete(synchronize_session=False)
-    db.commit()
+    await db.commit()
+    await favorites.publish_counts(db, [announcement_id])
     return {'detail': f'announcement with id {announcement_id} deleted'}
 
 
 @router.delete('/announcements/{announcement_id}', status_code=status.HTTP_200_OK, tags=['Users'])
-def delete_announcement(announcement_id: int, db: Session = Depends(database.get_db),
-                        current_user_id: models.Users = Depends(oath.get_current_user_id)):
-    removable_announcement = db.query(models.Announcements).filter(models.Announcements.id == announcement_id).first()
-    removable_files = db.query(models.Images).filter(models.Images.announcement_id == announcement_id).all()
+@budgets.query_budget(7, rows=1 + IMAGES_PER_ANNOUNCEMENT * (2 + len(thumbnails.DERIVATIVE_SIZES)))
+async def delete_announcement(announcement_id: int, db: AsyncSession = Depends(database.get_db),
+                              current_user_id: models.Users = Depends(oath.get_current_user_id)):
+    removable_announcement = await db.get(models.Announcements, announcement_id)
     if not removable_announcement:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f'Announcement with id {announcement_id} not found')
-    try:
-        for file in removable_files:
-            remove(file.data_path)
-        db.query(models.Announcements).filter(models.Announcements.id == announcement_id).delete(synchronize_session=False)
-        db.commit()
-    except FileNotFoundError as e:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='file not found')
+    files = await orphans.announcement_files(db, models.Announcements.id == announcement_id)
+    image_ids = await orphans.image_ids(db, models.Announcements.id == announcement_id)
+    await db.execute(delete(models.Announcements).where(models.Announcements.id == announcement_id))
+    await price_stats.apply(db, [(removable_announcement.town_id, removable_announcement.category_id,
+                                  removable_announcement.price, -1)])
+    await outbox.record(db, outbox.DELETED, [{'id': announcement_id, 'user_id': removable_announcement.user_id}])
+    await db.commit()
+    await cache.response_cache.invalidate('announcements')
+    media.forget_images(image_ids)
+    outbox.notify()
+    orphans.enqueue(files)
     return {'detail': f'обьявление с ID {announcement_id} удалено'}
 
 
 @router.get('/announcements/search/{word}', response_model=List[schemas.Announcement_schema_response], tags=['Users'])
-def search(word: str, db: Session = Depends(database.get_db),
-                        current_user: models.Users = Depends(oath.get_current_user_id)):
-    search_regex = f"%{word}%"
-    exact_match = db.query(models.Announcements).filter(models.Announcements.text == word).all()
-    like_match = db.query(models.Announcements).filter(models.Announcements.text.like(search_regex)).all()
-    if not exact_match or like_match:
+@budgets.query_budget(4, rows=PAGE_ROWS)
+@admission.cost(5, expensive=True)
+async def search(word: str, offset: int = Query(0, ge=0),
+                 limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+                 image_size: schemas.Image_size = schemas.Image_size.original,
+                 db: AsyncSession = Depends(database.get_read_db),
+                 current_user: models.Users = Depends(oath.get_current_user_id)):
+    """
+        - **word**: one or more words, announcements are ranked by relevance.
+        - **offset**, **limit**: page of the ranked result.
+    """
+    tokens = fulltext.tokenize(word)
+    if not tokens:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f'Search query must contain words of {fulltext.MIN_TOKEN_LENGTH} letters or more')
+    relevance = fulltext.relevance(tokens)
+    query = announcements_query(image_size).where(relevance > 0) \
+        .order_by(relevance.desc(), models.Announcements.id.desc()) \
+        .offset(offset).limit(limit)
+    announcements = (await db.execute(query)).scalars().all()
+    if not announcements and not offset:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Announcements with similar word not found')
-    return exact_match or like_match
+    return await serializers.announcements(announcements, image_size)
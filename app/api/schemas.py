@@ -1,5 +1,7 @@
+from datetime import datetime
+from enum import Enum
 from typing import Optional, List
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field, conint, conlist
 
 
 class Towns_schema(BaseModel):
@@ -42,6 +44,26 @@ class Announcement_schema(BaseModel):
         orm_mode = True
 
 
+class Announcement_import_schema(Announcement_schema):
+    user_id: int
+
+
+class Bulk_format(str, Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+class Import_error(BaseModel):
+    row: int
+    errors: List[str]
+
+
+class Import_report(BaseModel):
+    imported: int
+    failed: int
+    errors: List[Import_error]
+
+
 class Favorites_schema(BaseModel):
     id: int
     user_id: int
@@ -51,6 +73,14 @@ class Favorites_schema(BaseModel):
         orm_mode = True
 
 
+class Favorite_ids(BaseModel):
+    announcement_ids: conlist(int, min_items=1, max_items=1000)
+
+
+class Favorites_changed(BaseModel):
+    changed: int
+
+
 class ShortModelOfUser(BaseModel):
     first_name: str
     last_name: str
@@ -96,6 +126,19 @@ class User_announcement_mode(BaseModel):
         orm_mode = True
 
 
+class User_detail(str, Enum):
+    summary = 'summary'
+    counts = 'counts'
+    full = 'full'
+
+
+class User_details(User_announcement_mode):
+    announcements_count: Optional[int] = None
+    favorites_count: Optional[int] = None
+    announcement: Optional[List[Announcement_schema]] = None
+    favorite: Optional[List[ShowFav]] = None
+
+
 class Images_schema(BaseModel):
     data_path: str
     announcement_id: int
@@ -105,7 +148,9 @@ class Images_schema(BaseModel):
 
 
 class Show_Images(BaseModel):
-    data_path: str
+    data_path: str = Field(..., deprecated=True,
+                           description='Path of the file relative to the media directory, use url instead')
+    url: str
 
     class Config:
         orm_mode = True
@@ -118,11 +163,59 @@ class Announcement_schema_response(BaseModel):
     text: str
     town: Towns_schema
     image: List[Show_Images]
+    favorites_count: int = 0
 
     class Config:
         orm_mode = True
 
 
+class Announcement_sort(str, Enum):
+    newest = 'newest'
+    oldest = 'oldest'
+    price_asc = 'price_asc'
+    price_desc = 'price_desc'
+
+
+class Image_size(str, Enum):
+    original = 'original'
+    small = 'small'
+    medium = 'medium'
+
+
+class Facet_count(BaseModel):
+    id: int
+    count: int
+
+
+class Announcement_facets(BaseModel):
+    towns: List[Facet_count]
+    categories: List[Facet_count]
+
+
+class Price_stats(BaseModel):
+    town_id: int
+    category_id: int
+    town: Towns_schema
+    category: Categories_schema
+    count: int
+    average_price: float
+    lower_quartile: float
+    median_price: float
+    upper_quartile: float
+
+
+class Change_event(BaseModel):
+    id: int
+    event: str
+    announcement_id: int
+    payload: dict
+    created_at: datetime
+
+
+class Consumer_offset(BaseModel):
+    position: conint(ge=0)
+
+
 class Show_Categories(BaseModel):
     category_name: str
     id: int
@@ -131,5 +224,20 @@ class Show_Categories(BaseModel):
         orm_mode = True
 
 
+class Pool_status(BaseModel):
+    size: int
+    checked_out: int
+    checked_in: int
+    overflow: int
+    connects: int
+    checkouts: int
+    timeouts: int
+    invalidations: int
+    wait_seconds_total: float
+    wait_seconds_max: float
+
+
 class TokenData(BaseModel):
     name: Optional[str] = None
+    user_id: Optional[int] = None
+    version: Optional[int] = None
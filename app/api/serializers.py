@@ -0,0 +1,179 @@
+"""
+Announcement responses built from loaded rows and the reference data snapshot.
+
+Towns and categories come from refdata by id, so announcement queries only load
+announcements, their users and images. Both paths build JSON-native content
+shaped like Announcement_schema_response, which the response cache keeps and
+encode() turns into the same bytes FastAPI would send. fast_announcements is the
+opt-in path for large pages: it works on column tuples, without ORM objects.
+"""
+import json
+from typing import List
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+import refdata
+import schemas
+import storage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def image_path(image: models.Images, image_size: schemas.Image_size) -> str:
+    """
+    data_path of the requested derivative, the original while the image is not resized yet, relative to MEDIA_ROOT
+    """
+    if image_size == schemas.Image_size.original:
+        return storage.public_path(image.data_path)
+    derivatives = {derivative.size: derivative.data_path for derivative in image.derivative}
+    return storage.public_path(derivatives.get(image_size.value, image.data_path))
+
+
+def image_url(image_id: int, image_size: schemas.Image_size) -> str:
+    """
+    Path of the image on the /images endpoint
+    """
+    if image_size == schemas.Image_size.original:
+        return f'/images/{image_id}'
+    return f'/images/{image_id}?size={image_size.value}'
+
+
+def user(user: models.Users, ref: refdata.ReferenceData) -> dict:
+    return {
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'mobile_phone': user.mobile_phone,
+        'id': user.id,
+        'email': user.email,
+        'town': {'town_name': ref.towns[user.town_id].town_name},
+    }
+
+
+def announcement(announcement: models.Announcements, ref: refdata.ReferenceData,
+                 image_size: schemas.Image_size = schemas.Image_size.original) -> dict:
+    """
+    Announcement_schema_response fields of the announcement
+    """
+    return {
+        'user': user(announcement.user, ref),
+        'price': float(announcement.price),
+        'category': {'category_name': ref.categories[announcement.category_id].category_name},
+        'text': announcement.text,
+        'town': {'town_name': ref.towns[announcement.town_id].town_name},
+        'image': [{'data_path': image_path(image, image_size), 'url': image_url(image.id, image_size)}
+                  for image in announcement.image],
+        'favorites_count': announcement.favorites_count,
+    }
+
+
+async def announcements(rows: List[models.Announcements],
+                        image_size: schemas.Image_size = schemas.Image_size.original) -> List[dict]:
+    ref = await refdata.covering(
+        [row.town_id for row in rows] + [row.user.town_id for row in rows],
+        [row.category_id for row in rows],
+    )
+    return [announcement(row, ref, image_size) for row in rows]
+
+
+# columns of the fast path, everything Announcement_schema_response needs of the announcement row
+ANNOUNCEMENT_COLUMNS = (
+    models.Announcements.id,
+    models.Announcements.user_id,
+    models.Announcements.price,
+    models.Announcements.category_id,
+    models.Announcements.text,
+    models.Announcements.town_id,
+    models.Announcements.created_at,
+    models.Announcements.favorites_count,
+)
+
+
+def orjson_compatible(number: float) -> bool:
+    """
+    Whether orjson writes the float the way json (repr) does: they differ below 1e-4 and from 1e16 on,
+    e.g. 1e-05 becomes 0.00001, 1e-07 becomes 1e-7 and 1e+16 becomes 1e16
+    """
+    return number == 0 or 1e-4 <= abs(number) < 1e16
+
+
+def dumps(content, orjson_safe: bool = True) -> bytes:
+    """
+    Same bytes as fastapi's JSONResponse for JSON-native content. Content with floats orjson writes
+    differently (see orjson_compatible()) has to be passed with orjson_safe=False.
+    """
+    if orjson is not None and orjson_safe:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+def encode(content) -> bytes:
+    """
+    JSON of an announcement or a list of announcements built here
+    """
+    announcements = content if isinstance(content, list) else [content]
+    return dumps(content, all(orjson_compatible(announcement['price']) for announcement in announcements))
+
+
+async def fast_announcements(db: AsyncSession, rows, image_size: schemas.Image_size = schemas.Image_size.original):
+    """
+    Content of a page of ANNOUNCEMENT_COLUMNS rows, the same as announcements() gives for the rows
+    but built from plain tuples without ORM objects
+    """
+    if not rows:
+        return []
+    announcement_ids = [row.id for row in rows]
+    users = await db.execute(
+        select(models.Users.id, models.Users.first_name, models.Users.last_name, models.Users.mobile_phone,
+               models.Users.email, models.Users.town_id)
+        .where(models.Users.id.in_({row.user_id for row in rows}))
+    )
+    users = {user.id: user for user in users}
+    images = await db.execute(
+        select(models.Images.announcement_id, models.Images.id, models.Images.data_path)
+        .where(models.Images.announcement_id.in_(announcement_ids))
+        .order_by(models.Images.id)
+    )
+    images = images.all()
+    derivatives = {}
+    if image_size != schemas.Image_size.original and images:
+        derivatives = dict((await db.execute(
+            select(models.ImageDerivatives.image_id, models.ImageDerivatives.data_path)
+            .where(models.ImageDerivatives.image_id.in_([image.id for image in images]),
+                   models.ImageDerivatives.size == image_size.value)
+        )).all())
+    image_paths = {announcement_id: [] for announcement_id in announcement_ids}
+    for image in images:
+        image_paths[image.announcement_id].append({
+            'data_path': storage.public_path(derivatives.get(image.id, image.data_path)),
+            'url': image_url(image.id, image_size),
+        })
+
+    ref = await refdata.covering(
+        [row.town_id for row in rows] + [user.town_id for user in users.values()],
+        [row.category_id for row in rows],
+    )
+    content = []
+    for row in rows:
+        user = users[row.user_id]
+        content.append({
+            'user': {
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'mobile_phone': user.mobile_phone,
+                'id': user.id,
+                'email': user.email,
+                'town': {'town_name': ref.towns[user.town_id].town_name},
+            },
+            'price': float(row.price),
+            'category': {'category_name': ref.categories[row.category_id].category_name},
+            'text': row.text,
+            'town': {'town_name': ref.towns[row.town_id].town_name},
+            'image': image_paths[row.id],
+            'favorites_count': row.favorites_count,
+        })
+    return content
@@ -0,0 +1,157 @@
+"""
+Production entry point.
+
+    python serve.py migrate           creates the schema / applies pending migrations, once per deploy
+    python serve.py run               serves the API with WEB_CONCURRENCY worker processes
+    python serve.py startup-report    times importing and starting a worker, fails above --budget
+
+`run` uses gunicorn with uvicorn workers when gunicorn is installed. The app is
+imported once in the master process and the workers are forked from it, so a
+new worker skips the imports; each one creates its own database engines in its
+startup (database.connect()), no connection is shared across the fork.
+Restarts are rolling: SIGHUP starts new workers and lets the old ones finish
+their requests within GRACEFUL_TIMEOUT; to load new code, send SIGUSR2 (a new
+master with the new code starts next to the old one) and then SIGQUIT to the
+old master. MAX_REQUESTS recycles workers after that many requests.
+
+Without gunicorn, uvicorn's process manager runs the workers; it has no
+rolling restart.
+
+With more than one worker, `run` refuses to start while the response cache
+(CACHE_URL) or the rate limit buckets (RATE_LIMIT_URL) are kept in each worker:
+a write would only invalidate the cache of the worker that made it, and every
+worker would give a caller a burst of its own. --local-state starts anyway.
+
+The server never touches the schema: run `migrate` before starting it.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+import uvicorn
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+logger = logging.getLogger(__name__)
+
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', 8000))
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', os.cpu_count() or 1))
+GRACEFUL_TIMEOUT = int(os.getenv('GRACEFUL_TIMEOUT', 30))
+# 0: workers are never recycled
+MAX_REQUESTS = int(os.getenv('MAX_REQUESTS', 0))
+KEEPALIVE = int(os.getenv('KEEPALIVE', 5))
+# seconds the startup-report command allows for import and startup together
+STARTUP_BUDGET = float(os.getenv('STARTUP_BUDGET', 1))
+
+
+def import_app():
+    """
+    (the main module, seconds importing it took)
+    """
+    started = time.perf_counter()
+    import main
+    return main, time.perf_counter() - started
+
+
+if BaseApplication is not None:
+    class Server(BaseApplication):
+        def __init__(self, app, options: dict):
+            self.application = app
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+
+def process_local_state() -> list:
+    """
+    Descriptions of the state every worker would keep for itself
+    """
+    import admission
+    import cache
+    local = []
+    if not cache.CACHE_URL:
+        local.append('response cache and read-your-writes marks (set CACHE_URL)')
+    if admission.RATE_LIMITS != 'off' and not admission.RATE_LIMIT_URL:
+        local.append('rate limit buckets (set RATE_LIMIT_URL)')
+    return local
+
+
+def run(args):
+    main, import_seconds = import_app()
+    logger.info('app imported in %.3f s', import_seconds)
+    local = process_local_state() if args.workers > 1 else []
+    if local and not args.local_state:
+        logger.error('%d workers would each keep their own %s; pass --workers 1 or --local-state to serve anyway',
+                     args.workers, ', '.join(local))
+        sys.exit(1)
+    for state in local:
+        logger.warning('every worker keeps its own %s', state)
+    if BaseApplication is None:
+        logger.warning('gunicorn is not installed, serving without rolling restarts')
+        uvicorn.run('main:app', host=args.host, port=args.port, workers=args.workers,
+                    timeout_keep_alive=KEEPALIVE, proxy_headers=True)
+        return
+    Server(main.app, {
+        'bind': f'{args.host}:{args.port}',
+        'workers': args.workers,
+        'worker_class': 'uvicorn.workers.UvicornWorker',
+        'preload_app': True,
+        'graceful_timeout': GRACEFUL_TIMEOUT,
+        'timeout': GRACEFUL_TIMEOUT * 2,
+        'keepalive': KEEPALIVE,
+        'max_requests': MAX_REQUESTS,
+        'max_requests_jitter': MAX_REQUESTS // 10,
+    }).run()
+
+
+async def startup_report(budget: float) -> bool:
+    """
+    Prints the time of every startup step of a worker, returns whether all of them together fit in the budget
+    """
+    main, import_seconds = import_app()
+    try:
+        await main.app.router.startup()
+    finally:
+        await main.app.router.shutdown()
+    steps = {'import': import_seconds, **main.startup_seconds}
+    total = import_seconds + steps.pop('total')
+    for name, seconds in steps.items():
+        print(f'{name:<12} {seconds * 1000:8.1f} ms')
+    print(f'{"total":<12} {total * 1000:8.1f} ms (budget {budget * 1000:.0f} ms)')
+    return total <= budget
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Production server of the API')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('migrate', help='create the schema or apply pending migrations')
+    serve = commands.add_parser('run', help='serve the API')
+    serve.add_argument('--host', default=HOST)
+    serve.add_argument('--port', type=int, default=PORT)
+    serve.add_argument('--workers', type=int, default=WEB_CONCURRENCY)
+    serve.add_argument('--local-state', action='store_true',
+                       help='serve with several workers even if caches and rate limits are per worker')
+    report = commands.add_parser('startup-report', help='time the cold start of a worker')
+    report.add_argument('--budget', type=float, default=STARTUP_BUDGET, help='seconds')
+    args = parser.parse_args()
+    if args.command == 'migrate':
+        import migrations
+        asyncio.run(migrations.bootstrap())
+    elif args.command == 'run':
+        run(args)
+    elif not asyncio.run(startup_report(args.budget)):
+        sys.exit(1)
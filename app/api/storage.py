@@ -0,0 +1,149 @@
+"""
+Content-addressed storage of uploaded images.
+
+Files are streamed to disk in CHUNK_SIZE pieces while being hashed and are
+stored as MEDIA_ROOT/<first two hash chars>/<sha256><extension>, so the same
+photo uploaded twice takes the disk space once. A file can therefore be shared
+by several Images rows and is removed only when no row references it.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterable, Set
+
+from aiofiles import open
+from fastapi import UploadFile
+from sqlalchemy import func, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+import models
+
+MEDIA_ROOT = Path(os.getenv('MEDIA_ROOT', Path.cwd() / 'data'))
+CHUNK_SIZE = 64 * 1024
+
+EXTENSION_RE = re.compile(r'^\.[a-z0-9]{1,5}$')
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+# derivatives of images stored before content addressing, see thumbnails.derivative_path
+DERIVATIVE_NAME_RE = re.compile(r'^image-(\d+)$')
+
+
+def content_path(content_hash: str, extension: str) -> Path:
+    return MEDIA_ROOT / content_hash[:2] / f'{content_hash}{extension}'
+
+
+def public_path(path: str) -> str:
+    """
+    The stored path relative to MEDIA_ROOT, only the file name of a path outside of it: responses
+    must not show where the files are on the server
+    """
+    root = os.path.join(MEDIA_ROOT, '')
+    if path.startswith(root):
+        return path[len(root):]
+    return os.path.basename(path)
+
+
+def file_extension(filename: str) -> str:
+    extension = Path(filename or '').suffix.lower()
+    return extension if EXTENSION_RE.match(extension) else ''
+
+
+def _place(temp_path: str, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        os.remove(temp_path)
+        # marks the file as in use for remove_files(min_age=...) until the new row is committed
+        os.utime(path)
+    else:
+        os.replace(temp_path, path)
+
+
+async def save_upload(file: UploadFile):
+    """
+    Streams the upload to MEDIA_ROOT, returns (sha256 of the content, path of the stored file)
+    """
+    MEDIA_ROOT.mkdir(parents=True, exist_ok=True)
+    descriptor, temp_path = tempfile.mkstemp(dir=MEDIA_ROOT, suffix='.part')
+    os.close(descriptor)
+    digest = hashlib.sha256()
+    try:
+        async with open(temp_path, 'wb') as out_file:
+            while chunk := await file.read(CHUNK_SIZE):
+                digest.update(chunk)
+                await out_file.write(chunk)
+        content_hash = digest.hexdigest()
+        path = content_path(content_hash, file_extension(file.filename))
+        await run_in_threadpool(_place, temp_path, path)
+    except BaseException:
+        await run_in_threadpool(_remove, [temp_path])
+        raise
+    return content_hash, path
+
+
+def file_name(column):
+    """
+    SQL expression of the last component of a stored path
+    """
+    return func.substring_index(column, '/', -1)
+
+
+async def referenced(db: AsyncSession, paths: Iterable[str]) -> Set[str]:
+    """
+    Paths among the given ones that are still in use. Content-addressed files (originals and derivatives)
+    are in use while an Images row has their hash, derivatives named after an image id while that image
+    exists; other files are compared by resolved path with the rows of images without a content_hash
+    that have the same file name, so only the rows that can match are loaded.
+    No path string is compared as is, so a moved or symlinked MEDIA_ROOT doesn't orphan anything.
+    """
+    by_hash, by_image_id, others = {}, {}, []
+    for path in set(paths):
+        name = Path(path).stem
+        match = DERIVATIVE_NAME_RE.match(name)
+        if HASH_RE.match(name):
+            by_hash.setdefault(name, []).append(path)
+        elif match:
+            by_image_id.setdefault(int(match.group(1)), []).append(path)
+        else:
+            others.append(path)
+    used = set()
+    if by_hash:
+        hashes = await db.execute(select(models.Images.content_hash).distinct()
+                                  .where(models.Images.content_hash.in_(by_hash)))
+        for content_hash in hashes.scalars():
+            used.update(by_hash[content_hash])
+    if by_image_id:
+        image_ids = await db.execute(select(models.Images.id).where(models.Images.id.in_(by_image_id)))
+        for image_id in image_ids.scalars():
+            used.update(by_image_id[image_id])
+    if others:
+        names = {os.path.basename(path) for path in others}
+        stored = await db.execute(union_all(
+            select(models.Images.data_path)
+            .where(models.Images.content_hash.is_(None), file_name(models.Images.data_path).in_(names)),
+            select(models.ImageDerivatives.data_path).join(models.ImageDerivatives.image)
+            .where(models.Images.content_hash.is_(None), file_name(models.ImageDerivatives.data_path).in_(names)),
+        ))
+        stored = {os.path.realpath(path) for path in stored.scalars()}
+        used.update(path for path in others if os.path.realpath(path) in stored)
+    return used
+
+
+def _remove(paths: Iterable[str], min_age: float = 0):
+    deadline = time.time() - min_age
+    for path in paths:
+        try:
+            if min_age and os.stat(path).st_mtime > deadline:
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+async def remove_files(paths: Iterable[str], min_age: float = 0):
+    """
+    Removes the files, those modified less than min_age seconds ago are kept
+    """
+    await run_in_threadpool(_remove, list(paths), min_age)
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TaskQueue:
+    """
+    In-process background queue: `workers` asyncio tasks call `handler(item)` for every queued item.
+    Runs inside the server process, no broker needed. Items still queued when the process stops are lost,
+    so handlers must be idempotent and the work must be recoverable by a sweep.
+    """
+
+    def __init__(self, name: str, handler, workers: int = 1, maxsize: int = 10000):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue = None
+        self._tasks = []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def put(self, item) -> bool:
+        """
+        Queues the item, returns False when the queue is full or not started
+        """
+        if self._queue is None:
+            return False
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            logger.warning('%s queue is full, dropped %r', self.name, item)
+            return False
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _work(self):
+        while True:
+            item = await self._queue.get()
+            try:
+                await self.handler(item)
+            except Exception:
+                logger.exception('%s task %r failed', self.name, item)
+            finally:
+                self._queue.task_done()
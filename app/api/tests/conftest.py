@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# the app's modules import each other as top-level modules (import models, import schemas, ...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import budgets  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def enforce_query_budgets(monkeypatch):
+    """
+    A request over the query budget of its route, or to a route without one, fails the test
+    """
+    monkeypatch.setattr(budgets, 'QUERY_BUDGETS', 'enforce')
@@ -0,0 +1,92 @@
+"""
+With QUERY_BUDGETS=enforce (see conftest.py) a request over the budget of its route fails the test
+"""
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+import budgets
+import database
+import main
+import metrics
+import oath
+import storage
+from routers import user
+
+engine = create_engine('sqlite://')
+app = FastAPI()
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+def run(statements: int):
+    with engine.connect() as connection:
+        for _ in range(statements):
+            connection.execute(text('SELECT 1'))
+
+
+@app.get('/within')
+@budgets.query_budget(2, rows=2)
+async def within():
+    run(2)
+
+
+@app.get('/over')
+@budgets.query_budget(2, rows=2)
+async def over():
+    run(3)
+
+
+@app.get('/cached')
+@budgets.query_budget(0)
+async def cached():
+    with budgets.unbudgeted():
+        run(1)
+
+
+@app.get('/undeclared')
+async def undeclared():
+    pass
+
+
+client = TestClient(app)
+
+
+def test_within_budget():
+    assert client.get('/within').status_code == 200
+    assert client.get('/cached').status_code == 200
+
+
+def test_over_budget_fails():
+    with pytest.raises(budgets.QueryBudgetExceeded, match='3 SQL statements, budget 2'):
+        client.get('/over')
+
+
+def test_undeclared_budget_fails():
+    with pytest.raises(budgets.QueryBudgetExceeded, match='no query budget declared'):
+        client.get('/undeclared')
+
+
+def test_every_route_declares_a_budget():
+    assert [route.path for route in main.app.routes
+            if list(budgets.violations(getattr(route, 'endpoint', None), 0, 0))] == []
+
+
+def test_too_many_images_are_refused_before_saving(monkeypatch):
+    saved = []
+
+    async def save_upload(file):
+        saved.append(file)
+
+    async def get_db():
+        yield None
+
+    monkeypatch.setattr(storage, 'save_upload', save_upload)
+    monkeypatch.setitem(main.app.dependency_overrides, database.get_db, get_db)
+    monkeypatch.setitem(main.app.dependency_overrides, oath.get_current_user_id, lambda: 1)
+    files = [('files', (f'{i}.jpg', b'jpeg', 'image/jpeg')) for i in range(user.IMAGES_PER_ANNOUNCEMENT + 1)]
+    response = TestClient(main.app).post('/create_announcement', files=files,
+                                         data={'price': 1, 'category_id': 1, 'text': 'x', 'town_id': 1})
+    assert response.status_code == 422, response.text
+    assert response.json()['detail'][0]['loc'] == ['body', 'files']
+    assert saved == []
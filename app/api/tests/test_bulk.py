@@ -0,0 +1,53 @@
+"""
+The import parsers turn a stream of chunks into (row number, fields) records, None for a malformed one
+"""
+import asyncio
+
+import bulk
+import schemas
+
+CSV_HEADER = b'price,category_id,text,town_id,user_id\n'
+
+
+async def stream(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def records(format, *chunks):
+    async def collect():
+        return [record async for record in bulk.records(stream(*chunks), format)]
+    return asyncio.run(collect())
+
+
+def test_ndjson_records():
+    assert records(schemas.Bulk_format.ndjson, b'{"price": 1}\n\n{"pri', b'ce": 2}\nnot json\n[1, 2]\n{"text": "x"}') == [
+        (1, {'price': 1}), (2, {'price': 2}), (3, None), (4, None), (5, {'text': 'x'}),
+    ]
+
+
+def test_utf8_split_across_chunks_and_bom():
+    text = '{"text": "Велосипед"}\n'.encode('utf-8-sig')
+    assert records(schemas.Bulk_format.ndjson, text[:6], text[6:]) == [(1, {'text': 'Велосипед'})]
+
+
+def test_csv_records():
+    assert records(schemas.Bulk_format.csv, CSV_HEADER, b'10,1,"two\nlines",1,7\n', b'20,1,short\n') == [
+        (1, {'price': '10', 'category_id': '1', 'text': 'two\nlines', 'town_id': '1', 'user_id': '7'}),
+        (2, None),
+    ]
+
+
+def test_csv_stray_quote_is_a_malformed_record():
+    assert records(schemas.Bulk_format.csv, CSV_HEADER, b'1,2,"a"b",3,4\nx"y\n30,1,ok,1,7\n') == [
+        (1, None),
+        (2, {'price': '30', 'category_id': '1', 'text': 'ok', 'town_id': '1', 'user_id': '7'}),
+    ]
+
+
+def test_csv_unterminated_quote_at_the_end():
+    assert records(schemas.Bulk_format.csv, CSV_HEADER, b'1,1,"never closed,1,7\n') == [(1, None)]
+
+
+def test_csv_malformed_header_fails_every_record():
+    assert records(schemas.Bulk_format.csv, b'price,"a"b",x\ny"\n', b'1,1,t,1,7\n') == [(1, None)]
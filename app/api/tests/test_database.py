@@ -0,0 +1,113 @@
+"""
+Replica health checks run in the background, one at a time, and never hold a request up;
+a client's commit sends its reads to the primary in every worker
+"""
+import asyncio
+import itertools
+
+from fastapi import Request
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import cache
+import database
+
+
+def replica(status):
+    """
+    Replica whose SHOW SLAVE STATUS is answered by `status()`, counting the checks
+    """
+    replica = database.Replica(create_async_engine('mysql+aiomysql://replica/test'))
+    replica.checks = 0
+
+    async def replication_status():
+        replica.checks += 1
+        return await status()
+
+    replica._replication_status = replication_status
+    return replica
+
+
+def test_concurrent_requests_share_one_check():
+    async def run():
+        released = asyncio.Event()
+
+        async def status():
+            await released.wait()
+            return {'Seconds_Behind_Master': 0}
+
+        checked = replica(status)
+        # unknown until the first check is done: the primary serves meanwhile
+        assert [checked.is_available() for _ in range(100)] == [False] * 100
+        await asyncio.sleep(0)
+        released.set()
+        await asyncio.sleep(0.01)
+        assert checked.checks == 1
+        assert checked.is_available()
+        await checked.stop_checking()
+
+    asyncio.run(run())
+
+
+def test_hung_replica_does_not_block(monkeypatch):
+    monkeypatch.setattr(database, 'REPLICA_CHECK_INTERVAL', 0.05)
+
+    async def run():
+        async def status():
+            await asyncio.sleep(3600)
+
+        hung = replica(status)
+        hung.healthy = True
+        assert hung.is_available()
+        await asyncio.sleep(0.1)
+        assert not hung.is_available()
+        assert hung.checks == 1
+        await hung.stop_checking()
+
+    asyncio.run(run())
+
+
+def test_lagging_replica_is_unavailable():
+    async def run():
+        async def status():
+            return {'Seconds_Behind_Master': database.REPLICA_MAX_LAG + 1}
+
+        lagging = replica(status)
+        lagging.healthy = True
+        await lagging.check()
+        assert not lagging.is_available()
+        await lagging.stop_checking()
+
+    asyncio.run(run())
+
+
+def request(authorization):
+    return Request({'type': 'http', 'headers': [(b'authorization', authorization.encode())], 'client': None})
+
+
+def test_a_commit_is_seen_by_every_worker(monkeypatch):
+    # both workers read the same backend, as with CACHE_URL set
+    monkeypatch.setattr(cache, 'writers', cache.MemoryBackend())
+
+    async def run():
+        async with database.ClientSession() as db:
+            db.sync_session.info['client_key'] = 'Bearer writer'
+            await db.commit()
+        return await database.is_recent_writer(request('Bearer writer')), \
+            await database.is_recent_writer(request('Bearer reader'))
+
+    assert asyncio.run(run()) == (True, False)
+
+
+def test_recent_writers_skip_the_replicas(monkeypatch):
+    monkeypatch.setattr(cache, 'writers', cache.MemoryBackend())
+
+    async def run():
+        healthy = replica(None)
+        healthy.healthy, healthy.checked_at = True, float('inf')
+        monkeypatch.setattr(database, 'replicas', [healthy])
+        monkeypatch.setattr(database, '_next_replica', itertools.cycle([healthy]))
+        await cache.writers.set(database.writer_key('Bearer writer'), True, 10)
+        assert await database.choose_replica(request('Bearer writer')) is None
+        assert await database.choose_replica(request('Bearer reader')) is healthy
+
+    asyncio.run(run())
@@ -0,0 +1,93 @@
+"""
+Favorite toggles publish the new favorites_count to the cache backend; merge_counts puts the published
+counters into cached announcement content without a query
+"""
+import asyncio
+
+import pytest
+from fastapi import Request, Response
+
+import cache
+import favorites
+import serializers
+
+
+class Session:
+    def __init__(self, counts):
+        self.counts = counts
+        self.statements = 0
+
+    async def execute(self, statement):
+        self.statements += 1
+        return list(self.counts.items())
+
+
+@pytest.fixture(autouse=True)
+def backend(monkeypatch):
+    backend = cache.MemoryBackend()
+    monkeypatch.setattr(cache, 'response_cache', cache.ResponseCache(backend))
+    monkeypatch.setattr(cache, 'writers', cache.MemoryBackend())
+    return backend
+
+
+def announcement(text, count):
+    return {'text': text, 'price': 1.0, 'image': [{'data_path': 'a.jpg', 'url': '/images/1'}],
+            'favorites_count': count}
+
+
+def publish(counts):
+    session = Session(counts)
+    asyncio.run(favorites.publish_counts(session, counts))
+    return session
+
+
+def merge(content, ids):
+    return asyncio.run(favorites.merge_counts(content, ids))
+
+
+def test_counts_follow_the_ids():
+    publish({1: 5, 2: 0, 3: 12})
+    content = [announcement('a', 0), announcement('b', 3), announcement('c', 1)]
+    assert [merged['favorites_count'] for merged in merge(content, [1, 2, 3])] == [5, 0, 12]
+    # the cached content itself is left as it was
+    assert [cached['favorites_count'] for cached in content] == [0, 3, 1]
+
+
+def test_single_announcement():
+    publish({4: 9})
+    assert merge(announcement('x', 0), [4]) == announcement('x', 9)
+
+
+def test_unpublished_count_stays_as_cached():
+    publish({2: 8})
+    merged = merge([announcement('a', 3), announcement('b', 1)], [1, 2])
+    assert [announcement['favorites_count'] for announcement in merged] == [3, 8]
+
+
+def test_nothing_to_publish_runs_no_query():
+    assert publish({}).statements == 0
+    assert merge([], []) == []
+
+
+def test_cache_hits_run_no_query():
+    produced = []
+
+    async def produce():
+        produced.append(1)
+        return [announcement('a', 0)], [1]
+
+    async def refresh(content, ids):
+        return serializers.encode(await favorites.merge_counts(content, ids))
+
+    def respond(headers=()):
+        request = Request({'type': 'http', 'method': 'GET', 'path': '/announcements', 'query_string': b'',
+                           'headers': list(headers), 'client': None})
+        return asyncio.run(cache.response_cache.respond(request, Response(), 'announcements', None, produce,
+                                                        refresh))
+
+    first = respond()
+    publish({1: 4})
+    second = respond()
+    assert produced == [1]
+    assert b'"favorites_count":0' in first.body and b'"favorites_count":4' in second.body
+    assert respond([(b'if-none-match', second.headers['etag'].encode())]).status_code == 304
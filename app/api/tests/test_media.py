@@ -0,0 +1,43 @@
+"""
+Lookups of images by id expire sooner than by hash and are forgotten with the image rows
+"""
+import asyncio
+import time
+
+import pytest
+
+import media
+import schemas
+
+
+@pytest.fixture(autouse=True)
+def image_files(monkeypatch):
+    monkeypatch.setattr(media, 'image_files', media.TTLCache(ttl=media.IMAGE_CACHE_TTL))
+
+
+def find(key, image_size, ttl=media.IMAGE_CACHE_TTL, info=('a.jpg', '"a"', True)):
+    async def load():
+        return info
+    return asyncio.run(media.find(key, image_size, load, ttl))
+
+
+def test_forget_images_drops_every_size_of_the_ids():
+    for image_size in schemas.Image_size:
+        find(1, image_size)
+        find(2, image_size)
+    find('a' * 64, schemas.Image_size.original)
+    media.forget_images([1])
+    assert [key for key, _ in media.image_files._data] == [2] * len(schemas.Image_size) + ['a' * 64]
+
+
+def expires_in(key, image_size) -> float:
+    return media.image_files._data[(key, image_size)][0] - time.monotonic()
+
+
+def test_ttl_of_the_lookup():
+    find(1, schemas.Image_size.original, media.IMAGE_ID_CACHE_TTL)
+    find(1, schemas.Image_size.small, 3600, info=('a.jpg', '"a"', False))
+    find(2, schemas.Image_size.small, 10, info=('a.jpg', '"a"', False))
+    assert media.IMAGE_ID_CACHE_TTL - 1 < expires_in(1, schemas.Image_size.original) <= media.IMAGE_ID_CACHE_TTL
+    assert media.PROVISIONAL_TTL - 1 < expires_in(1, schemas.Image_size.small) <= media.PROVISIONAL_TTL
+    assert 9 < expires_in(2, schemas.Image_size.small) <= 10
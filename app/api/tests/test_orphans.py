@@ -0,0 +1,26 @@
+"""
+The collection walks MEDIA_ROOT for files old enough to be orphans
+"""
+import os
+import time
+
+import orphans
+
+
+def touch(path, age):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'x')
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return str(path)
+
+
+def test_old_files_include_leftover_parts(tmp_path):
+    old = touch(tmp_path / 'ab' / 'old.jpg', 7200)
+    crashed_upload = touch(tmp_path / 'tmpk2j4.part', 7200)
+    crashed_render = touch(tmp_path / 'thumbs' / 'small' / 'ab' / 'ab12.webp.4711.part', 7200)
+    touch(tmp_path / 'ab' / 'young.jpg', 10)
+    touch(tmp_path / 'uploading.part', 10)
+    touch(tmp_path / '.hidden', 7200)
+    files = [path for batch in orphans._old_files(tmp_path, 3600) for path in batch]
+    assert sorted(files) == sorted([old, crashed_upload, crashed_render])
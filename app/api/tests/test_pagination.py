@@ -0,0 +1,51 @@
+"""
+Keyset pages continue from the values in the cursor, whatever happened to the last row since
+"""
+import pytest
+from sqlalchemy import Column, Float, Integer, MetaData, Table, create_engine, delete, insert, select, update
+
+import pagination
+
+metadata = MetaData()
+items = Table('items', metadata, Column('id', Integer, primary_key=True), Column('price', Float(precision=53)))
+ORDER = [(items.c.price, False), (items.c.id, False)]
+
+
+@pytest.fixture
+def connection():
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    with engine.connect() as connection:
+        connection.execute(insert(items), [{'id': i, 'price': price}
+                                           for i, price in enumerate([0.1, 0.2, 0.30000000000000004, 1e-7, 99.99], 1)])
+        yield connection
+
+
+def page(connection, cursor, limit=2):
+    query = select(items.c.id)
+    if cursor:
+        query = query.where(pagination.keyset_filter(ORDER, pagination.decode_cursor(cursor, ORDER)))
+    query = query.order_by(*[column.desc() if descending else column.asc() for column, descending in ORDER])
+    return connection.execute(query.limit(limit)).scalars().all()
+
+
+def cursor_after(connection, item_id):
+    row = connection.execute(select(items.c.price, items.c.id).where(items.c.id == item_id)).one()
+    return pagination.encode_cursor([row.price, row.id])
+
+
+def test_pages_cover_every_row_once(connection):
+    assert page(connection, None, 5) == [4, 1, 2, 3, 5]
+    assert page(connection, cursor_after(connection, 1), 5) == [2, 3, 5]
+
+
+def test_last_row_deleted(connection):
+    cursor = cursor_after(connection, 1)
+    connection.execute(delete(items).where(items.c.id == 1))
+    assert page(connection, cursor, 5) == [2, 3, 5]
+
+
+def test_last_row_repriced(connection):
+    cursor = cursor_after(connection, 1)
+    connection.execute(update(items).where(items.c.id == 1).values(price=50))
+    assert page(connection, cursor, 5) == [2, 3, 1, 5]
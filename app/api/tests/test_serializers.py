@@ -0,0 +1,138 @@
+"""
+The fast path of the listings (serializers.fast_announcements) must produce the same content as
+the ORM path, and serializers.encode() the same bytes as FastAPI validating and encoding it.
+"""
+import asyncio
+import json
+from collections import namedtuple
+from pathlib import Path
+from typing import List
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import parse_obj_as
+
+import models
+import refdata
+import schemas
+import serializers
+import storage
+
+UserRow = namedtuple('UserRow', 'id first_name last_name mobile_phone email town_id')
+ImageRow = namedtuple('ImageRow', 'announcement_id id data_path')
+AnnouncementRow = namedtuple('AnnouncementRow', [column.key for column in serializers.ANNOUNCEMENT_COLUMNS])
+
+PRICES = [0.0, 1500.0, 0.5, 99.99, 1e-4, 1e-05, 1e-7, 12345678.9, 9.99e15, 1e16, 2.5e17]
+
+
+class Result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def all(self):
+        return self.rows
+
+
+class Session:
+    """
+    Answers the statements of fast_announcements in the order it runs them
+    """
+
+    def __init__(self, *results):
+        self.results = list(results)
+
+    async def execute(self, statement):
+        return Result(self.results.pop(0))
+
+
+@pytest.fixture(autouse=True)
+def reference_data(monkeypatch):
+    monkeypatch.setattr(refdata, 'current', refdata.ReferenceData(
+        1,
+        {1: schemas.Towns_schema(town_name='Москва'), 2: schemas.Towns_schema(town_name='Казань')},
+        {1: schemas.Categories_schema(category_name='Транспорт')},
+    ))
+
+
+@pytest.fixture(autouse=True)
+def media_root(monkeypatch):
+    monkeypatch.setattr(storage, 'MEDIA_ROOT', Path('/media'))
+
+
+def orm_body(announcements, image_size):
+    content = asyncio.run(serializers.announcements(announcements, image_size))
+    return JSONResponse(jsonable_encoder(parse_obj_as(List[schemas.Announcement_schema_response], content))).body
+
+
+def fast_body(announcements, image_size):
+    users = {announcement.user.id: announcement.user for announcement in announcements}
+    images = [image for announcement in announcements for image in announcement.image]
+    results = [
+        [UserRow(user.id, user.first_name, user.last_name, user.mobile_phone, user.email, user.town_id)
+         for user in users.values()],
+        [ImageRow(image.announcement_id, image.id, image.data_path) for image in images],
+    ]
+    if image_size != schemas.Image_size.original:
+        results.append([(image.id, derivative.data_path)
+                        for image in images for derivative in image.derivative if derivative.size == image_size.value])
+    rows = [AnnouncementRow(*(getattr(announcement, column.key) for column in serializers.ANNOUNCEMENT_COLUMNS))
+            for announcement in announcements]
+    return serializers.encode(asyncio.run(serializers.fast_announcements(Session(*results), rows, image_size)))
+
+
+def make_announcements(prices):
+    user = models.Users(id=7, first_name='Иван', last_name='Петров', mobile_phone=79001234567,
+                        email='ivan@example.com', town_id=2)
+    announcements = []
+    for number, price in enumerate(prices, start=1):
+        image = models.Images(id=number * 10, announcement_id=number, data_path=f'/media/ab/{number:064x}.jpg')
+        image.derivative = [models.ImageDerivatives(image_id=image.id, size='small',
+                                                    data_path=f'/media/thumbs/small/ab/{number:064x}.webp')]
+        announcements.append(models.Announcements(
+            id=number, user_id=user.id, user=user, price=price, category_id=1, text=f'Объявление "{number}"\n',
+            town_id=1, created_at=None, favorites_count=number % 3, image=[image] if number % 2 else [],
+        ))
+    return announcements
+
+
+@pytest.mark.parametrize('image_size', list(schemas.Image_size))
+def test_fast_path_matches_orm_path(image_size):
+    announcements = make_announcements(PRICES)
+    assert fast_body(announcements, image_size) == orm_body(announcements, image_size)
+
+
+@pytest.mark.parametrize('price', PRICES)
+def test_fast_path_matches_orm_path_for_price(price):
+    announcements = make_announcements([price])
+    assert fast_body(announcements, schemas.Image_size.original) == orm_body(announcements, schemas.Image_size.original)
+
+
+@pytest.mark.parametrize('price', PRICES + [7])
+def test_orm_content_encodes_like_fastapi(price):
+    announcements = make_announcements([price])
+    content = asyncio.run(serializers.announcements(announcements))
+    assert serializers.encode(content) == orm_body(announcements, schemas.Image_size.original)
+    assert serializers.encode(content[0]) == JSONResponse(jsonable_encoder(
+        parse_obj_as(schemas.Announcement_schema_response, content[0]))).body
+
+
+def test_empty_page():
+    assert asyncio.run(serializers.fast_announcements(Session(), [])) == []
+
+
+@pytest.mark.parametrize('image_size, expected', [
+    (schemas.Image_size.original, f'ab/{1:064x}.jpg'),
+    (schemas.Image_size.small, f'thumbs/small/ab/{1:064x}.webp'),
+])
+def test_data_path_is_relative_to_media_root(image_size, expected):
+    [announcement] = json.loads(fast_body(make_announcements([1.0]), image_size))
+    assert announcement['image'] == [{'data_path': expected, 'url': serializers.image_url(10, image_size)}]
+
+
+def test_data_path_outside_media_root_is_the_file_name():
+    assert storage.public_path('/srv/old-uploads/image-1.jpg') == 'image-1.jpg'
+    assert storage.public_path('/mediafiles/a.jpg') == 'a.jpg'
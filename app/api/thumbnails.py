@@ -0,0 +1,164 @@
+"""
+Resized derivatives of announcement images.
+
+After an announcement is created its image ids are put on `queue`; the queue
+workers render every size of DERIVATIVE_SIZES in a process pool and record the
+files in image_derivatives. Derivatives are content-addressed like originals,
+so a photo shared by several images is rendered once.
+
+Images the queue lost (a restart, a full queue) are rendered by sweep() in the
+background of a starting worker. GET_LOCK lets one worker sweep at a time, the
+others starting with it skip the sweep instead of rendering the same images.
+"""
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image, ImageOps
+from sqlalchemy import select, text
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+import database
+import models
+import storage
+from tasks import TaskQueue
+
+logger = logging.getLogger(__name__)
+
+# size name -> longest side in pixels
+DERIVATIVE_SIZES = {'small': 320, 'medium': 1024}
+DERIVATIVE_FORMAT = os.getenv('THUMBNAIL_FORMAT', 'WEBP').upper()
+DERIVATIVE_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', 80))
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', 2))
+# images without derivatives rendered on startup, e.g. after a restart dropped the queue
+SWEEP_LIMIT = int(os.getenv('THUMBNAIL_SWEEP_LIMIT', 1000))
+SWEEP_LOCK = 'thumbnails_sweep'
+
+EXTENSIONS = {'WEBP': '.webp', 'JPEG': '.jpg'}
+
+
+def derivative_path(image: models.Images, size: str) -> Path:
+    name = image.content_hash or f'image-{image.id}'
+    return storage.MEDIA_ROOT / 'thumbs' / size / name[:2] / f'{name}{EXTENSIONS[DERIVATIVE_FORMAT]}'
+
+
+def render(source: str, target: str, max_side: int):
+    if os.path.exists(target):
+        return
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        image.thumbnail((max_side, max_side))
+        if DERIVATIVE_FORMAT == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = f'{target}.{os.getpid()}.part'
+        image.save(temp_path, format=DERIVATIVE_FORMAT, quality=DERIVATIVE_QUALITY)
+        os.replace(temp_path, target)
+
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+    return _executor
+
+
+async def generate(image_id: int):
+    async with database.SessionLocal() as db:
+        image = await db.get(models.Images, image_id)
+        if image is None:
+            return
+        done = await db.execute(select(models.ImageDerivatives.size)
+                                .where(models.ImageDerivatives.image_id == image_id))
+        done = set(done.scalars().all())
+        loop = asyncio.get_running_loop()
+        for size, max_side in DERIVATIVE_SIZES.items():
+            if size in done:
+                continue
+            target = derivative_path(image, size)
+            await loop.run_in_executor(get_executor(), render, image.data_path, str(target), max_side)
+            db.add(models.ImageDerivatives(image_id=image_id, size=size, data_path=str(target)))
+        try:
+            await db.commit()
+        except IntegrityError:
+            # rendered concurrently by another worker
+            await db.rollback()
+
+
+queue = TaskQueue('thumbnails', generate, workers=THUMBNAIL_WORKERS)
+
+
+def enqueue(image_ids):
+    for image_id in image_ids:
+        queue.put(image_id)
+
+
+async def missing(limit: int = SWEEP_LIMIT):
+    async with database.SessionLocal() as db:
+        rows = await db.execute(
+            select(models.Images.id)
+            .where(~models.Images.derivative.any())
+            .order_by(models.Images.id.desc())
+            .limit(limit)
+        )
+        return rows.scalars().all()
+
+
+async def sweep() -> Optional[int]:
+    """
+    Renders the derivatives of up to SWEEP_LIMIT images that have none, returns their number,
+    None if another process is sweeping
+    """
+    async with database.engine.connect() as conn:
+        locked = (await conn.execute(text('SELECT GET_LOCK(:name, 0)'), {'name': SWEEP_LOCK})).scalar()
+        # the lock is held by the session, not by the transaction the SELECT began
+        await conn.commit()
+        if not locked:
+            return None
+        try:
+            image_ids = await missing()
+            for image_id in image_ids:
+                try:
+                    await generate(image_id)
+                except Exception:
+                    logger.exception('could not render the derivatives of image %d', image_id)
+            return len(image_ids)
+        finally:
+            await conn.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': SWEEP_LOCK})
+            await conn.commit()
+
+
+async def _sweep_in_background():
+    try:
+        rendered = await sweep()
+        if rendered:
+            logger.info('rendered the derivatives of %d images', rendered)
+    except SQLAlchemyError:
+        logger.exception('could not render images without derivatives')
+
+
+_sweep_task = None
+
+
+async def start():
+    global _sweep_task
+    queue.start()
+    _sweep_task = asyncio.create_task(_sweep_in_background())
+
+
+async def stop():
+    global _executor, _sweep_task
+    if _sweep_task is not None:
+        _sweep_task.cancel()
+        await asyncio.gather(_sweep_task, return_exceptions=True)
+        _sweep_task = None
+    await queue.stop()
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None